@@ -0,0 +1,73 @@
+from auth import requires_admin, credential_cache
+import entity_cache
+import instrumentation
+from flask.ext.restful import Resource, reqparse, abort
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+__author__ = 'wojtowpj'
+
+JOB_BATCH_SIZE = 200
+
+# Maintenance jobs (migrations, rebuilds) by name. Each job processes one batch per call and
+# returns (processed, next_cursor); callers repeat with next_cursor until it comes back empty.
+admin_jobs = {}
+FINISHED_CACHE_PREFIX = 'finished_job:'
+# unfinished jobs are checked again after this long, a finished job stays finished
+FINISHED_CACHE_TIME = 60
+_finished_jobs = set()
+
+
+class FinishedJob(db.Model):
+    """Records that the admin job named by the key_name has processed its last batch"""
+    finished = db.DateTimeProperty(auto_now=True)
+
+
+def job_finished(name):
+    """Returns whether the job has run to its last batch, code can drop its pre-migration fallbacks once it has"""
+    if name in _finished_jobs:
+        return True
+    finished = memcache.get(FINISHED_CACHE_PREFIX + name)
+    if finished is None:
+        finished = FinishedJob.get_by_key_name(name) is not None
+        memcache.set(FINISHED_CACHE_PREFIX + name, finished, time=FINISHED_CACHE_TIME)
+    if finished:
+        _finished_jobs.add(name)
+    return finished
+
+
+def admin_job(name):
+    def register(f):
+        admin_jobs[name] = f
+        return f
+
+    return register
+
+
+class AdminJobApi(Resource):
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('cursor', type=str)
+
+        super(AdminJobApi, self).__init__()
+
+    @requires_admin
+    def post(self, name):
+        job = admin_jobs.get(name)
+        if job is None:
+            abort(404, message="Job '%s' not found" % name)
+        args = self.reqparse.parse_args()
+        processed, next_cursor = job(args.cursor)
+        if next_cursor is None:
+            FinishedJob(key_name=name).put()
+            memcache.set(FINISHED_CACHE_PREFIX + name, True, time=FINISHED_CACHE_TIME)
+        return {'job': name, 'processed': processed, 'next_cursor': next_cursor}
+
+
+class StatsApi(Resource):
+    @requires_admin
+    def get(self):
+        return {'window_seconds': instrumentation.WINDOW_SECONDS,
+                'endpoints': instrumentation.snapshot(),
+                'credential_cache': credential_cache.stats(),
+                'entity_cache': entity_cache.local_cache_stats()}
@@ -1,14 +1,155 @@
-from passlib.hash import sha512_crypt
+import hashlib
+import hmac
+import os
+import time
 from functools import wraps
-from flask import request, Response, abort
+from flask import request, Response, abort, g
+from google.appengine.api import memcache
 from google.appengine.ext import db
+from cache import TtlCache
+from instrumentation import timed
 
+TOKEN_TTL = 3600
+# after a revocation memcache refuses adds of the generation for this long, so a check that read the old
+# generation just before the write cannot put it back into the cache
+TOKEN_GENERATION_LOCK_SECONDS = 2
+# the datastore's limit on key names, longer user names cannot have been indexed
+MAX_KEY_NAME_BYTES = 1500
 
-def check_auth(user_name, password):
+# Recently verified credentials, keyed on a keyed digest of user name and password so
+# plaintext never sits in memory. The cache is per instance, so the ttl bounds how long
+# another instance can keep accepting a password that has since been changed.
+credential_cache = TtlCache(max_size=1024, ttl=120)
+_credential_key = os.urandom(32)
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _credential_digest(user_name, password):
+    return hmac.new(_credential_key, '%s\0%s' % (_to_bytes(user_name), _to_bytes(password)),
+                    hashlib.sha256).digest()
+
+
+class UserNameIndex(db.Model):
+    """Maps a user_name (the key_name) to the id of its User so logins are a get by key"""
+    user_id = db.IntegerProperty(required=True)
+
+
+def index_user_name(user):
+    return UserNameIndex(key_name=user.user_name, user_id=user.key().id())
+
+
+def user_name_index_key(user_name):
+    return db.Key.from_path('UserNameIndex', user_name)
+
+
+def get_user_by_name(user_name):
+    if not user_name or len(_to_bytes(user_name)) > MAX_KEY_NAME_BYTES:
+        return None
+    index = UserNameIndex.get_by_key_name(user_name)
+    if index is not None:
+        return db.get(db.Key.from_path('User', index.user_id))
+    # users created before the index existed are indexed the first time they are looked up
     user = db.GqlQuery("SELECT * from User WHERE user_name = :user", user=user_name).get()
+    if user is not None:
+        index_user_name(user).put()
+    return user
+
+
+def check_auth(user_name, password):
+    digest = _credential_digest(user_name, password)
+    cached = credential_cache.get(digest)
+    if cached is not None:
+        g.user_id = cached[1]
+        return True
+    user = get_user_by_name(user_name)
     if user is None:
         return False
-    return sha512_crypt.verify(password, user.password)
+    with timed('auth'):
+        verified = _password_hasher().verify(password, user.password)
+    if not verified:
+        return False
+    credential_cache.set(digest, (user_name, user.key().id()))
+    g.user, g.user_id = user, user.key().id()
+    return True
+
+
+def invalidate_credentials(user_name):
+    credential_cache.delete_where(lambda digest, cached: cached[0] == user_name)
+
+
+class AuthSecret(db.Model):
+    secret = db.BlobProperty(required=True)
+
+
+_token_secret = None
+
+
+def _get_token_secret():
+    global _token_secret
+    if _token_secret is None:
+        _token_secret = AuthSecret.get_or_insert('token', secret=db.Blob(os.urandom(32))).secret
+    return _token_secret
+
+
+def _sign(payload):
+    return hmac.new(_get_token_secret(), payload, hashlib.sha256).hexdigest()
+
+
+def _safe_equals(a, b):
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def _token_generation_key(user_id):
+    return 'token_generation:%d' % user_id
+
+
+def _current_token_generation(user_id):
+    generation = memcache.get(_token_generation_key(user_id))
+    if generation is None:
+        user = db.get(db.Key.from_path('User', user_id))
+        if user is None:
+            return None
+        generation = user.token_generation or 0
+        memcache.add(_token_generation_key(user_id), generation)
+    return generation
+
+
+def issue_token(user):
+    payload = '%d.%d.%d' % (user.key().id(), user.token_generation or 0, int(time.time()) + TOKEN_TTL)
+    return '%s.%s' % (payload, _sign(payload))
+
+
+def check_token(token):
+    try:
+        user_id, generation, expires, signature = token.split('.')
+        user_id, generation, expires = int(user_id), int(generation), int(expires)
+    except ValueError:
+        return None
+    if not _safe_equals(_to_bytes(signature), _sign('%d.%d.%d' % (user_id, generation, expires))):
+        return None
+    if expires < time.time() or generation != _current_token_generation(user_id):
+        return None
+    return user_id
+
+
+def revoke_tokens(user):
+    """Bumps the user's token generation, call before putting the user and call tokens_revoked after the put"""
+    user.token_generation = (user.token_generation or 0) + 1
+
+
+def tokens_revoked(user):
+    """Drops the cached token generation once the user is put or deleted, the next check reads the datastore"""
+    memcache.delete(_token_generation_key(user.key().id()), seconds=TOKEN_GENERATION_LOCK_SECONDS)
 
 
 def authenticate():
@@ -16,25 +157,75 @@ def authenticate():
     return abort(401)
 
 
+def _password_hasher():
+    # imported on first use, passlib loads its hash handlers at import and most requests are served from
+    # the credential cache or a bearer token without them
+    from passlib.hash import sha512_crypt
+    return sha512_crypt
+
+
 def hash_password(password):
-    return sha512_crypt.encrypt(password)
+    with timed('auth'):
+        return _password_hasher().encrypt(password)
 
 
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-        if not auth or not check_auth(auth.username, auth.password):
-            return authenticate()
+        g.user, g.user_id = None, None
+        header = request.headers.get('Authorization', '')
+        if header.startswith('Bearer '):
+            user_id = check_token(header[len('Bearer '):].strip())
+            if user_id is None:
+                return authenticate()
+            g.user_id = user_id
+        else:
+            auth = request.authorization
+            if not auth or not check_auth(auth.username, auth.password):
+                return authenticate()
         return f(*args, **kwargs)
 
     return decorated
 
 
-def get_user():
-    auth = request.authorization
-    user_name = auth.username
-    u = db.GqlQuery("SELECT * FROM User WHERE user_name = :user_name", user_name=user_name).get()
-    return u
+def requires_task_queue(f):
+    """Only lets through requests made by the task queue or cron, app.yaml also restricts /_tasks to admins"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if 'X-AppEngine-QueueName' not in request.headers and 'X-AppEngine-Cron' not in request.headers:
+            abort(403)
+        return f(*args, **kwargs)
+
+    return decorated
 
 
+def requires_admin(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        user = get_user()
+        if user is None or user.user_name != 'admin':
+            abort(403)
+        return f(*args, **kwargs)
+
+    return requires_auth(decorated)
+
+
+def get_user_key():
+    """Returns the authenticated user's key, without a datastore get when the id is already known"""
+    user_id = getattr(g, 'user_id', None)
+    if user_id is not None:
+        return db.Key.from_path('User', user_id)
+    return get_user().key()
+
+
+def get_user():
+    """Returns the authenticated User, loaded at most once per request"""
+    user = getattr(g, 'user', None)
+    if user is None:
+        user_id = getattr(g, 'user_id', None)
+        if user_id is not None:
+            user = db.get(db.Key.from_path('User', user_id))
+        else:
+            user = get_user_by_name(request.authorization.username)
+        g.user = user
+    return user
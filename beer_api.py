@@ -2,11 +2,24 @@ from beer_glass_api import BeerGlass
 from user_api import User
 
 __author__ = 'wojtowpj'
-from auth import requires_auth, get_user
-from db_helper import IdUrlField, update_model, generate_sorted_query, ReferenceUrlField
-from flask.ext.restful import Resource, fields, reqparse, marshal, abort
+from auth import requires_auth, get_user, get_user_key
+import entity_cache
+from versioning import conditional, bump_version
+from throttle import acquire, remembered, beer_add_throttle, ThrottleMarker
+from admin_api import admin_job, JOB_BATCH_SIZE
+from serializer import compile_fields
+from db_helper import IdUrlField, update_model, ReferenceUrlField, list_response, narrow, requested_ids, ids_response
+from flask.ext.restful import Resource, fields, reqparse, abort
 from google.appengine.ext import db
 import datetime
+import re
+import unicodedata
+
+BEER_ADD_PERIOD = datetime.timedelta(days=1)
+BEER_ADD_LIMIT_MESSAGE = 'User can only add one beer per day.'
+MAX_PREFIX_LENGTH = 20
+DEFAULT_TYPEAHEAD_LIMIT = 10
+MAX_TYPEAHEAD_LIMIT = 50
 
 
 class Beer(db.Model):
@@ -19,6 +32,44 @@ class Beer(db.Model):
     brewery_location = db.StringProperty()
     beer_glass = db.ReferenceProperty(BeerGlass)
 
+
+class BeerNameIndex(db.Model):
+    """Normalised name prefixes of a beer for typeahead lookups, the id is the beer's id"""
+    name = db.StringProperty(indexed=False)
+    sort_name = db.StringProperty()
+    prefixes = db.StringListProperty()
+
+
+def normalize_name(name):
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    return unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').lower().strip()
+
+
+def name_terms(normalized):
+    """The normalised name and each word in it, typeahead matches prefixes of any of them"""
+    return [normalized] + re.split('[^a-z0-9]+', normalized)
+
+
+def name_prefixes(name):
+    """Every prefix of the name's terms, up to MAX_PREFIX_LENGTH characters"""
+    prefixes = set()
+    for word in name_terms(normalize_name(name)):
+        prefixes.update(word[:i] for i in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1))
+    return sorted(prefixes)
+
+
+def name_index_key(beer_key):
+    return db.Key.from_path('BeerNameIndex', beer_key.id())
+
+
+def name_index(beer):
+    return BeerNameIndex(key=name_index_key(beer.key()),
+                         name=beer.name,
+                         sort_name=normalize_name(beer.name),
+                         prefixes=name_prefixes(beer.name))
+
+
 glass_uri_fields = {
     'name': fields.String,
     'uri': IdUrlField('beer_glass', absolute=True),
@@ -35,6 +86,21 @@ beer_fields = {
     'beer_glass': fields.Nested(glass_uri_fields),
     'uri': IdUrlField('beer', absolute=True),
 }
+marshal_beer = compile_fields(beer_fields)
+
+beer_name_fields = {
+    'name': fields.String,
+    'uri': IdUrlField('beer', absolute=True),
+}
+marshal_beer_name = compile_fields(beer_name_fields)
+
+beer_filters = {
+    'style': ('style', '=', str),
+    'min_abv': ('abv', '>=', float),
+    'max_abv': ('abv', '<=', float),
+    'min_ibu': ('ibu', '>=', float),
+    'max_ibu': ('ibu', '<=', float),
+}
 
 
 class BeerListApi(Resource):
@@ -52,29 +118,31 @@ class BeerListApi(Resource):
         super(BeerListApi, self).__init__()
 
     @requires_auth
+    @conditional('Beer', 'BeerGlass')
     def get(self):
-        beer_list = []
-        for b in generate_sorted_query(Beer):
-            beer_list.append(b)
-        return {'beer': map(lambda b: marshal(b, beer_fields), beer_list)}
+        ids = requested_ids()
+        if ids is not None:
+            return ids_response('beer', Beer, marshal_beer, ids, [Beer.beer_glass])
+        return list_response('beer', Beer, marshal_beer, [Beer.beer_glass], beer_filters)
 
     @requires_auth
     def post(self):
         args = self.reqparse.parse_args()
+        # a repeat within the day is rejected from memcache before anything is read, admins never hold the throttle
+        throttle = beer_add_throttle(get_user_key())
+        next_allowed = remembered(throttle)
+        if next_allowed is not None:
+            abort(429, message=BEER_ADD_LIMIT_MESSAGE, allowed_in=round(next_allowed))
         b = Beer.all(keys_only=True).filter('name', args.name).get()
         if b:
             abort(409, message="Beer with name '%s' already exists" % args.name)
         g = None
         if args.beer_glass_id:
-            g = BeerGlass.get_by_id(args.beer_glass_id)
+            g = entity_cache.get_by_id(BeerGlass, args.beer_glass_id)
         u = get_user()
         if u is None:
             abort(404, message="User not found.")
         date_added = datetime.datetime.utcnow()
-        if u.last_beer_add_date is not None and u.user_name != "admin":
-            next_allowed = (u.last_beer_add_date + datetime.timedelta(days=1) - date_added).total_seconds()
-            if next_allowed > 0:
-                abort(429, message="User can only add one beer per day.", allowed_in=round(next_allowed))
 
         if args.description is not None:
             args.description = args.description[:500]
@@ -86,10 +154,17 @@ class BeerListApi(Resource):
                  style=args.style,
                  brewery_location=args.brewery_location,
                  beer_glass=g)
-        b.put()
+        if u.user_name == "admin":
+            b.put()
+        else:
+            next_allowed = acquire(throttle, BEER_ADD_PERIOD, [b])
+            if next_allowed is not None:
+                abort(429, message=BEER_ADD_LIMIT_MESSAGE, allowed_in=round(next_allowed))
         u.last_beer_add_date = date_added
-        u.put()
-        return marshal(b, beer_fields)
+        db.put([u, name_index(b)])
+        entity_cache.invalidate(u)
+        bump_version('Beer')
+        return marshal_beer(b)
 
 
 class BeerApi(Resource):
@@ -107,9 +182,10 @@ class BeerApi(Resource):
         super(BeerApi, self).__init__()
 
     @requires_auth
+    @conditional('Beer', 'BeerGlass')
     def get(self, id):
-        beer = Beer.get_by_id(id)
-        return {'beer': marshal(beer, beer_fields)}
+        beer = entity_cache.get_by_id(Beer, id)
+        return {'beer': narrow(marshal_beer)(beer)}
 
     @requires_auth
     def put(self, id):
@@ -119,18 +195,76 @@ class BeerApi(Resource):
             abort(404)
         g = None
         if args.beer_glass_id is not None:
-            g = BeerGlass.get_by_id(args.beer_glass_id)
+            g = entity_cache.get_by_id(BeerGlass, args.beer_glass_id)
             b.beer_glass = g
 
         u = dict(filter(lambda (k, v): v is not None, args.items()))
+        renamed = u.get('name', b.name) != b.name
+        restyled = u.get('style', b.style) != b.style
         update_model(b, u)
-        b.put()
-        return marshal(b, beer_fields)
+        db.put([b, name_index(b)] if renamed else [b])
+        entity_cache.invalidate(b)
+        bump_version('Beer')
+        if restyled:
+            # review_summary imports this module, the fold task refreshes the summary with the new style
+            from review_summary import schedule_fold
+            schedule_fold(b.key())
+        return marshal_beer(b)
 
     @requires_auth
     def delete(self, id):
         b = Beer.get_by_id(id)
         if b:
-            b.delete()
-            return {'beer': marshal(b, beer_fields), 'action': 'deleted'}
+            db.delete([b, name_index_key(b.key())])
+            entity_cache.invalidate(b)
+            bump_version('Beer')
+            return {'beer': marshal_beer(b), 'action': 'deleted'}
         abort(404)
+
+
+class BeerSearchApi(Resource):
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('q', type=unicode, required=True, location='args', help='q is required')
+        self.reqparse.add_argument('limit', type=int, default=DEFAULT_TYPEAHEAD_LIMIT, location='args')
+
+        super(BeerSearchApi, self).__init__()
+
+    @requires_auth
+    @conditional('Beer')
+    def get(self):
+        args = self.reqparse.parse_args()
+        if not 0 < args.limit <= MAX_TYPEAHEAD_LIMIT:
+            abort(400, message="limit must be between 1 and %d" % MAX_TYPEAHEAD_LIMIT)
+        prefix = normalize_name(args.q)
+        if not prefix:
+            return {'beer': []}
+        query = BeerNameIndex.all().filter('prefixes', prefix[:MAX_PREFIX_LENGTH]).order('sort_name')
+        if len(prefix) <= MAX_PREFIX_LENGTH:
+            matches = query.fetch(args.limit)
+        else:
+            # only the first MAX_PREFIX_LENGTH characters are indexed, longer prefixes are checked here
+            matches = [m for m in query.run(limit=MAX_TYPEAHEAD_LIMIT * 4)
+                       if any(term.startswith(prefix) for term in name_terms(m.sort_name))][:args.limit]
+        return {'beer': marshal_beer_name(matches)}
+
+
+@admin_job('beer_name_index')
+def index_beer_names(cursor):
+    query = Beer.all()
+    if cursor:
+        query.with_cursor(cursor)
+    beers = query.fetch(JOB_BATCH_SIZE)
+    db.put([name_index(b) for b in beers])
+    return len(beers), query.cursor() if len(beers) == JOB_BATCH_SIZE else None
+
+
+@admin_job('beer_add_throttle_markers')
+def create_beer_add_throttle_markers(cursor):
+    query = User.all().filter('last_beer_add_date >', datetime.datetime.utcnow() - BEER_ADD_PERIOD)
+    if cursor:
+        query.with_cursor(cursor)
+    users = query.fetch(JOB_BATCH_SIZE)
+    db.put([ThrottleMarker(key_name=beer_add_throttle(u.key()), expires=u.last_beer_add_date + BEER_ADD_PERIOD)
+            for u in users])
+    return len(users), query.cursor() if len(users) == JOB_BATCH_SIZE else None
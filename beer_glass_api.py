@@ -1,6 +1,9 @@
 from auth import requires_auth
-from db_helper import IdUrlField, update_model
-from flask.ext.restful import Resource, fields, reqparse, marshal, abort
+import entity_cache
+from versioning import conditional, bump_version
+from serializer import compile_fields
+from db_helper import IdUrlField, update_model, list_response, narrow
+from flask.ext.restful import Resource, fields, reqparse, abort
 
 __author__ = 'wojtowpj'
 
@@ -19,6 +22,7 @@ glass_fields = {
     'capacity': fields.Float,
     'uri': IdUrlField('beer_glass', absolute=True),
 }
+marshal_glass = compile_fields(glass_fields)
 
 
 class BeerGlassListApi(Resource):
@@ -31,11 +35,9 @@ class BeerGlassListApi(Resource):
         super(BeerGlassListApi, self).__init__()
 
     @requires_auth
+    @conditional('BeerGlass')
     def get(self):
-        glass_list = []
-        for g in db.Query(BeerGlass):
-            glass_list.append(g)
-        return {'beer_glasses': map(lambda g: marshal(g, glass_fields), glass_list)}
+        return list_response('beer_glasses', BeerGlass, marshal_glass)
 
     @requires_auth
     def post(self):
@@ -47,7 +49,8 @@ class BeerGlassListApi(Resource):
                       description=args.get('description'),
                       capacity=args.get('capacity'))
         g.put()
-        return {'beer_glass': marshal(g, glass_fields)}
+        bump_version('BeerGlass')
+        return {'beer_glass': marshal_glass(g)}
 
 
 class BeerGlassApi(Resource):
@@ -60,11 +63,12 @@ class BeerGlassApi(Resource):
         super(BeerGlassApi, self).__init__()
 
     @requires_auth
+    @conditional('BeerGlass')
     def get(self, id):
-        g = BeerGlass.get_by_id(id)
+        g = entity_cache.get_by_id(BeerGlass, id)
         if not g:
             abort(404)
-        return {'beer_glass': marshal(g, glass_fields)}
+        return {'beer_glass': narrow(marshal_glass)(g)}
 
     @requires_auth
     def put(self, id):
@@ -77,12 +81,16 @@ class BeerGlassApi(Resource):
         update_model(g, u)
 
         g.put()
-        return {'beer_glass': marshal(g, glass_fields)}
+        entity_cache.invalidate(g)
+        bump_version('BeerGlass')
+        return {'beer_glass': marshal_glass(g)}
 
     @requires_auth
     def delete(self, id):
         g = BeerGlass.get_by_id(id)
         if g:
             g.delete()
-            return {"beer_glass": marshal(g, glass_fields), 'action': 'deleted'}
+            entity_cache.invalidate(g)
+            bump_version('BeerGlass')
+            return {"beer_glass": marshal_glass(g), 'action': 'deleted'}
         abort(404)
@@ -1,40 +1,63 @@
 #!flask/bin/python
-from auth import hash_password
-from beer_api import BeerListApi, BeerApi
+from admin_api import AdminJobApi, StatsApi
+import instrumentation
+from beer_api import BeerListApi, BeerApi, BeerSearchApi
 from beer_glass_api import BeerGlassListApi, BeerGlassApi
-from beer_review_api import BeerReviewListApi, BeerReviewApi, BeerReviewBeerApi, BeerReviewUserApi
+from bulk_api import BeerBulkApi, BeerGlassBulkApi, ReviewBulkApi
+from beer_review_api import BeerReviewListApi, BeerReviewApi, BeerReviewBeerApi, BeerReviewUserApi, \
+    ReviewSummaryTaskApi, ReviewSummarySweepTaskApi, UserStatsTaskApi
+from leaderboard import LeaderboardApi, LeaderboardUpdateTaskApi, UPDATE_TASK_URL
+from recommendations import RecommendationsApi, RecommendationsRebuildTaskApi, REBUILD_TASK_URL
 from favorites_api import FavoritesUserApi, FavoritesListApi, FavoritesApi, FavoritesBeerApi
-from user_api import UserApi, UserListApi, User
+from user_api import UserApi, UserListApi, TokenApi, seed_admin
+from review_summary import FOLD_TASK_URL, SWEEP_TASK_URL
+from user_stats import STATS_TASK_URL
 from flask import Flask
 from flask.ext.restful import Api
 
 
 app = Flask(__name__)
 api = Api(app)
+instrumentation.init_app(app)
 
+api.add_resource(TokenApi, '/api/v1.0/token', endpoint='token')
 api.add_resource(UserListApi, '/api/v1.0/users', endpoint='users')
 api.add_resource(UserApi, '/api/v1.0/users/<int:id>', endpoint='user')
 api.add_resource(BeerReviewUserApi, '/api/v1.0/users/<int:id>/reviews', endpoint='user_reviews')
+api.add_resource(RecommendationsApi, '/api/v1.0/users/<int:id>/recommendations', endpoint='user_recommendations')
 api.add_resource(BeerGlassListApi, '/api/v1.0/beer_glasses', endpoint='beer_glasses')
 api.add_resource(BeerGlassApi, '/api/v1.0/beer_glasses/<int:id>', endpoint='beer_glass')
+api.add_resource(BeerGlassBulkApi, '/api/v1.0/beer_glasses/bulk', endpoint='beer_glasses_bulk')
 api.add_resource(BeerListApi, '/api/v1.0/beers', endpoint='beers')
 api.add_resource(BeerApi, '/api/v1.0/beers/<int:id>', endpoint='beer')
+api.add_resource(BeerBulkApi, '/api/v1.0/beers/bulk', endpoint='beers_bulk')
+api.add_resource(LeaderboardApi, '/api/v1.0/beers/top', endpoint='leaderboard')
+api.add_resource(BeerSearchApi, '/api/v1.0/beers/search', endpoint='beer_search')
 api.add_resource(BeerReviewBeerApi, '/api/v1.0/beers/<int:id>/reviews', endpoint='beer_reviews')
 api.add_resource(BeerReviewListApi, '/api/v1.0/beer_reviews', endpoint='reviews')
 api.add_resource(BeerReviewApi, '/api/v1.0/beer_reviews/<int:id>', endpoint='review')
+api.add_resource(ReviewBulkApi, '/api/v1.0/beer_reviews/bulk', endpoint='reviews_bulk')
 api.add_resource(FavoritesUserApi, '/api/v1.0/users/<int:id>/favorites', endpoint='user_favorites')
 api.add_resource(FavoritesBeerApi, '/api/v1.0/beers/<int:id>/favorites', endpoint='beer_favorites')
 api.add_resource(FavoritesListApi, '/api/v1.0/favorites', endpoint='favorites')
-api.add_resource(FavoritesApi, '/api/v1.0/favorites/<int:id>', endpoint='favorite')
+api.add_resource(FavoritesApi, '/api/v1.0/favorites/<id>', endpoint='favorite')
+api.add_resource(AdminJobApi, '/api/v1.0/admin/jobs/<name>', endpoint='admin_job')
+api.add_resource(StatsApi, '/api/v1.0/_stats', endpoint='stats')
+api.add_resource(ReviewSummaryTaskApi, FOLD_TASK_URL, endpoint='fold_review_summary')
+api.add_resource(ReviewSummarySweepTaskApi, SWEEP_TASK_URL, endpoint='sweep_review_summary')
+api.add_resource(UserStatsTaskApi, STATS_TASK_URL, endpoint='fold_user_stats')
+api.add_resource(RecommendationsRebuildTaskApi, REBUILD_TASK_URL, endpoint='rebuild_recommendations')
+api.add_resource(LeaderboardUpdateTaskApi, UPDATE_TASK_URL, endpoint='update_leaderboards')
 
-# Create initial user if the user does not exist
-u = User.all().get()
-if u is None:
-    u = User(user_name='admin',
-             first_name='Admin',
-             last_name='Admin',
-             password=hash_password('beer_app1'))
-    u.put()
+
+# The initial admin user is created by the warmup request a new instance gets before it serves traffic,
+# not at import, so instances start without a datastore round trip. /_tasks/bootstrap does the same
+# for deployments that do not send warmup requests.
+@app.route('/_ah/warmup')
+@app.route('/_tasks/bootstrap')
+def bootstrap():
+    seed_admin()
+    return ''
 
 
 if __name__ == '__main__':
@@ -4,11 +4,21 @@ __author__ = 'wojtowpj'
 
 from beer_api import Beer
 from user_api import User
-from auth import requires_auth, get_user
-from db_helper import IdUrlField, generate_sorted_query
-from flask.ext.restful import Resource, fields, reqparse, marshal, abort
+from auth import requires_auth, requires_task_queue, get_user, get_user_key
+import entity_cache
+from serializer import compile_fields
+from db_helper import IdUrlField, datetime_arg, generate_sorted_query, prefetch_references, fetch_page, \
+    stream_requested, stream_list, list_response, narrow, requested_ids, ids_response
+from flask.ext.restful import Resource, fields, reqparse, abort
 from flask import request
 from google.appengine.ext import db
+from throttle import acquire, remembered, review_throttle, ThrottleMarker
+from admin_api import admin_job, JOB_BATCH_SIZE
+from favorites_api import Favorites
+from user_stats import UserStats, PendingUserStats, stats_key, update_stats, get_stats, marshal_user_stats, \
+    fold_pending_stats
+from review_summary import BeerReviewSummary, get_summary, merge_summaries, pending_scores, schedule_fold, \
+    fold_pending_reviews, sweep_pending_reviews, score_sums, SCORE_FIELDS
 
 
 class BeerReview(db.Model):
@@ -24,17 +34,6 @@ class BeerReview(db.Model):
     comments = db.StringProperty()
 
 
-class BeerReviewSummary(db.Model):
-    beer = db.ReferenceProperty(Beer, required=True)
-    count = db.IntegerProperty()
-    aroma = db.FloatProperty(required=True)
-    appearance = db.FloatProperty(required=True)
-    taste = db.FloatProperty(required=True)
-    palate = db.FloatProperty(required=True)
-    bottle_style = db.FloatProperty(required=True)
-    overall = db.FloatProperty(required=True)
-
-
 beer_reference_fields = {
     'name': fields.String,
     'uri': IdUrlField('beer', absolute=True),
@@ -58,6 +57,7 @@ beer_review_fields = {
     'comments': fields.String,
     'uri': IdUrlField('review', absolute=True)
 }
+marshal_review = compile_fields(beer_review_fields)
 
 beer_review_summary_fields = {
     'count': fields.Integer,
@@ -69,6 +69,19 @@ beer_review_summary_fields = {
     'overall': fields.Float,
     'beer': fields.Nested(beer_reference_fields),
 }
+marshal_review_summary = compile_fields(beer_review_summary_fields)
+
+
+review_filters = dict(('min_%s' % f, (f, '>=', float)) for f in SCORE_FIELDS)
+review_filters.update({
+    'created_after': ('date_created', '>=', datetime_arg),
+    'created_before': ('date_created', '<', datetime_arg),
+})
+
+
+def marshal_merged_summaries(summaries):
+    return marshal_review_summary(prefetch_references(merge_summaries(summaries), BeerReviewSummary.beer))
+
 
 post_parser = reqparse.RequestParser()
 post_parser.add_argument('aroma', type=float, required=True, help='aroma is required')
@@ -90,33 +103,33 @@ class BeerReviewListApi(Resource):
     def get(self):
         args = self.getparse.parse_args()
         if args.type == 'summary':
-            summaries = []
-            for s in generate_sorted_query(BeerReviewSummary):
-                summaries.append(s)
-            return {'beer_review_summaries': map(lambda s: marshal(s, beer_review_summary_fields), summaries)}
-        else:
-            review_list = []
-            for r in generate_sorted_query(BeerReview):
-                review_list.append(r)
-            return {'beer_reviews': map(lambda r: marshal(r, beer_review_fields), review_list)}
+            if stream_requested():
+                return stream_list('beer_review_summaries', generate_sorted_query(BeerReviewSummary),
+                                   marshal_merged_summaries)
+            summaries, next_cursor = fetch_page(generate_sorted_query(BeerReviewSummary))
+            return {'beer_review_summaries': marshal_merged_summaries(summaries), 'next_cursor': next_cursor}
+        ids = requested_ids()
+        if ids is not None:
+            return ids_response('beer_reviews', BeerReview, marshal_review, ids, [BeerReview.beer, BeerReview.user])
+        return list_response('beer_reviews', BeerReview, marshal_review, [BeerReview.beer, BeerReview.user],
+                             review_filters)
 
     @requires_auth
     def post(self):
         args = post_parser.parse_args()
         if args.get('beer_id') is None:
             abort(400, message="beer_id is required")
-        b = Beer.get_by_id(args.beer_id)
 
-        return add_review(b, args)
+        return add_review(args.beer_id, args)
 
 
 class BeerReviewApi(Resource):
     @requires_auth
     def get(self, id):
-        r = BeerReview.get_by_id(id)
+        r = entity_cache.get_by_id(BeerReview, id)
         if not r:
             abort(404)
-        return {"beer_review": marshal(r, beer_review_fields)}
+        return {"beer_review": narrow(marshal_review)(r)}
 
 
 class BeerReviewBeerApi(Resource):
@@ -128,102 +141,156 @@ class BeerReviewBeerApi(Resource):
 
     @requires_auth
     def get(self, id):
-        review_list = []
-        b = Beer.get_by_id(id)
+        b = entity_cache.get_by_id(Beer, id)
         if not b:
             abort(404, message="Beer not found")
         args = self.reqparse.parse_args()
         if args.type == 'summary':
-            summary = BeerReviewSummary.all().filter('beer', b).get()
-            return {'beer_review_summary': marshal(summary, beer_review_summary_fields)}
+            summary = get_summary(b.key())
+            if summary is not None:
+                summary.beer = b
+            return {'beer_review_summary': marshal_review_summary(summary)}
         else:
-            for r in generate_sorted_query(BeerReview).filter('beer', b):
-                review_list.append(r)
-            return {'beer_reviews': map(lambda r: marshal(r, beer_review_fields), review_list)}
+            return list_response('beer_reviews', BeerReview, marshal_review, [BeerReview.beer, BeerReview.user],
+                                 review_filters, beer=b)
 
     @requires_auth
     def post(self, id):
         args = post_parser.parse_args()
-        b = Beer.get_by_id(id)
 
-        return add_review(b, args)
+        return add_review(id, args)
 
 
 class BeerReviewUserApi(Resource):
     def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('type', type=str, location='args')
+
         super(BeerReviewUserApi, self).__init__()
 
     @requires_auth
     def get(self, id):
-        review_list = []
-        u = User.get_by_id(id)
+        u = entity_cache.get_by_id(User, id)
         if not u:
             abort(404, message="User not found")
-        for r in generate_sorted_query(BeerReview).filter('user', u):
-            review_list.append(r)
+        args = self.reqparse.parse_args()
+        if args.type == 'summary':
+            return {'user_review_summary': marshal_user_stats(get_stats(u.key()))}
+        return list_response('beer_reviews', BeerReview, marshal_review, [BeerReview.beer, BeerReview.user],
+                             review_filters, user=u)
 
-        return {'beer_reviews': map(lambda r: marshal(r, beer_review_fields), review_list)}
 
+class UserStatsTaskApi(Resource):
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('user_id', type=int, required=True, help='user_id is required')
 
-def moving_average(prev, current, count):
-    return prev + (current - prev) / count
+        super(UserStatsTaskApi, self).__init__()
 
+    @requires_task_queue
+    def post(self):
+        args = self.reqparse.parse_args()
+        folded = fold_pending_stats(db.Key.from_path('User', args.user_id))
+        return {'user_id': args.user_id, 'folded': folded}
 
-def add_review(beer, review_dict):
-    def create_review_summary(beer_review):
-        summary = BeerReviewSummary.all().filter('beer', beer_review.beer).get()
-        if summary:
-            summary.count += 1
-            summary.aroma = moving_average(summary.aroma, beer_review.aroma, summary.count)
-            summary.appearance = moving_average(summary.appearance, beer_review.appearance, summary.count)
-            summary.taste = moving_average(summary.taste, beer_review.taste, summary.count)
-            summary.palate = moving_average(summary.palate, beer_review.palate, summary.count)
-            summary.bottle_style = moving_average(summary.bottle_style, beer_review.bottle_style, summary.count)
-            summary.overall = moving_average(summary.overall, beer_review.overall, summary.count)
-        else:
-            summary = BeerReviewSummary(count=1,
-                                        beer=beer_review.beer,
-                                        aroma=beer_review.aroma,
-                                        appearance=beer_review.appearance,
-                                        taste=beer_review.taste,
-                                        palate=beer_review.palate,
-                                        bottle_style=beer_review.bottle_style,
-                                        overall=beer_review.overall)
 
-        summary.put()
+class ReviewSummaryTaskApi(Resource):
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('beer_id', type=int, required=True, help='beer_id is required')
+
+        super(ReviewSummaryTaskApi, self).__init__()
+
+    @requires_task_queue
+    def post(self):
+        args = self.reqparse.parse_args()
+        folded = fold_pending_reviews(db.Key.from_path('Beer', args.beer_id))
+        return {'beer_id': args.beer_id, 'folded': folded}
+
+
+class ReviewSummarySweepTaskApi(Resource):
+    @requires_task_queue
+    def get(self):
+        return {'scheduled': sweep_pending_reviews()}
 
-    if beer is None:
-        abort(404, message="Beer %s not found.")
-    user = get_user()
-    if user is None:
-        abort(404, message="User is not found.")
 
-    date_added = datetime.datetime.utcnow()
-    r = BeerReview.all() \
-        .filter('beer', beer) \
-        .filter('user', user) \
-        .filter('date_created >', date_added - datetime.timedelta(days=7)) \
-        .get()
+REVIEW_PERIOD = datetime.timedelta(days=7)
+REVIEW_LIMIT_MESSAGE = 'Only one review per user per beer per week allowed.'
 
-    if r:
-        allowed_in = (r.date_created + datetime.timedelta(days=7) - date_added).total_seconds()
-        abort(429, message="Only one review per user per beer per week allowed.", allowed_in=round(allowed_in))
 
+def new_review(beer, user, review_dict):
     scores = [float(review_dict['aroma']), float(review_dict['appearance']), float(review_dict['taste']),
               float(review_dict['palate']),
               float(review_dict['bottle_style'])]
     overall = (sum(scores) / len(scores))
-    r = BeerReview(beer=beer,
-                   user=user,
-                   aroma=review_dict['aroma'],
-                   appearance=review_dict['appearance'],
-                   taste=review_dict['taste'],
-                   palate=review_dict['palate'],
-                   bottle_style=review_dict['bottle_style'],
-                   overall=overall,
-                   comments=review_dict.get('comments'))
-
-    r.put()
-    create_review_summary(r)
-
-    return {'beer_review': marshal(r, beer_review_fields)}
+    return BeerReview(beer=beer,
+                      user=user,
+                      aroma=review_dict['aroma'],
+                      appearance=review_dict['appearance'],
+                      taste=review_dict['taste'],
+                      palate=review_dict['palate'],
+                      bottle_style=review_dict['bottle_style'],
+                      overall=overall,
+                      comments=review_dict.get('comments'))
+
+
+def add_review(beer_id, review_dict):
+    # a repeat within the week is rejected from memcache before the beer and the user are read
+    throttle = review_throttle(get_user_key(), db.Key.from_path('Beer', beer_id))
+    allowed_in = remembered(throttle)
+    if allowed_in is not None:
+        abort(429, message=REVIEW_LIMIT_MESSAGE, allowed_in=round(allowed_in))
+    beer = entity_cache.get_by_id(Beer, beer_id)
+    if beer is None:
+        abort(404, message="Beer %s not found.")
+    user = get_user()
+    if user is None:
+        abort(404, message="User is not found.")
+
+    r = new_review(beer, user, review_dict)
+    # the throttle marker, the review, its pending scores and the user's stats commit together, the summary is
+    # updated by the fold task
+    allowed_in = acquire(throttle, REVIEW_PERIOD, [r, pending_scores(beer.key(), r)],
+                         in_transaction=lambda: update_stats(user.key(), reviews=[r]))
+    if allowed_in is not None:
+        abort(429, message=REVIEW_LIMIT_MESSAGE, allowed_in=round(allowed_in))
+    schedule_fold(beer.key())
+
+    return {'beer_review': marshal_review(r)}
+
+
+
+@admin_job('review_throttle_markers')
+def create_review_throttle_markers(cursor):
+    query = BeerReview.all().filter('date_created >', datetime.datetime.utcnow() - REVIEW_PERIOD)
+    if cursor:
+        query.with_cursor(cursor)
+    reviews = query.fetch(JOB_BATCH_SIZE)
+    db.put([ThrottleMarker(key_name=review_throttle(BeerReview.user.get_value_for_datastore(r),
+                                                    BeerReview.beer.get_value_for_datastore(r)),
+                           expires=r.date_created + REVIEW_PERIOD)
+            for r in reviews])
+    return len(reviews), query.cursor() if len(reviews) == JOB_BATCH_SIZE else None
+
+
+@admin_job('user_stats')
+def rebuild_user_stats(cursor):
+    query = User.all(keys_only=True)
+    if cursor:
+        query.with_cursor(cursor)
+    user_keys = query.fetch(JOB_BATCH_SIZE)
+    stats = []
+    for user_key in user_keys:
+        # reviews still pending for the stats are counted from the reviews below
+        db.delete(list(PendingUserStats.all(keys_only=True).ancestor(stats_key(user_key)).run()))
+        user_stats = UserStats(key=stats_key(user_key))
+        reviews = list(BeerReview.all().filter('user', user_key).run(batch_size=JOB_BATCH_SIZE))
+        if reviews:
+            user_stats.review_count = len(reviews)
+            for f, total in score_sums(reviews).items():
+                setattr(user_stats, f + '_sum', total)
+            user_stats.last_activity = max(r.date_created for r in reviews)
+        user_stats.favorite_count = Favorites.all(keys_only=True).filter('user', user_key).count(limit=None)
+        stats.append(user_stats)
+    db.put(stats)
+    return len(user_keys), query.cursor() if len(user_keys) == JOB_BATCH_SIZE else None
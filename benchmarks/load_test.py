@@ -0,0 +1,534 @@
+"""Seeds the local datastore stub with a realistic dataset and drives every route with a concurrent request mix.
+
+The app runs in process against the SDK's datastore, memcache and taskqueue stubs (through testbed), so
+runs are reproducible and need no deployment: the dataset and the request mix are drawn from --seed.
+Datastore RPCs are counted with an apiproxy hook, latencies are measured around each test client call.
+Run from the project root with the App Engine SDK importable (or APPENGINE_SDK pointing at it):
+
+    python benchmarks/load_test.py --scale 0.1 --requests 2000 --threads 8 --output load_test.json
+
+The default scale seeds 10k beers, 1k users, 200k reviews and 200k favorites. Absolute numbers are those
+of the stubs, compare runs of the same scale and seed on the same machine. The run exits non-zero when a
+request failed with a 5xx or a route was not exercised, so a broken harness or app is not mistaken for a
+slow one.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PASSWORD = 'load_test'
+ADMIN_PASSWORD = 'beer_app1'
+CLIENT_USERS = 50
+PUT_BATCH_SIZE = 500
+STYLES = ['IPA', 'Stout', 'Porter', 'Pilsner', 'Lager', 'Saison', 'Witbier', 'Dubbel', 'Tripel', 'Bock',
+          'Doppelbock', 'Hefeweizen', 'Kolsch', 'Gose', 'Sour', 'Barleywine', 'Brown Ale', 'Pale Ale', 'Amber',
+          'Red Ale', 'Scotch Ale', 'Rauchbier', 'Marzen', 'Dunkel', 'Helles']
+WORDS = ['Hop', 'Dark', 'Golden', 'Old', 'River', 'Mountain', 'Night', 'Wild', 'Red', 'Iron', 'Stone', 'Velvet',
+         'Harvest', 'Winter', 'Summer', 'Black', 'Citrus', 'Oak', 'Smoke', 'Honey']
+
+
+def setup_path():
+    sdk = os.environ.get('APPENGINE_SDK')
+    if sdk:
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path[0:0] = [ROOT, os.path.join(ROOT, 'lib')]
+
+
+def activate_stubs(datastore_file):
+    """Registers the stubs before beer_manager is imported, instrumentation hooks the apiproxy it finds"""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.setup_env(app_id='dev~beer-manager-414', overwrite=True)
+    bed.activate()
+    # the sqlite stub keeps index rows, the file stub scans every entity of a kind for each query
+    bed.init_datastore_v3_stub(use_sqlite=True, datastore_file=datastore_file, require_indexes=True,
+                               root_path=ROOT,
+                               consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_app_identity_stub()
+    bed.init_urlfetch_stub()
+    return bed
+
+
+class RpcCounter(object):
+    """Counts datastore RPCs made by the current thread"""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('load_test', self.post_call, 'datastore_v3')
+
+    def post_call(self, service, call, rpc_request, rpc_response, rpc=None, error=None):
+        self.local.count = self.count() + 1
+
+    def count(self):
+        return getattr(self.local, 'count', 0)
+
+
+def put_batched(entities):
+    from google.appengine.ext import db
+    keys = []
+    for i in range(0, len(entities), PUT_BATCH_SIZE):
+        keys.extend(db.put(entities[i:i + PUT_BATCH_SIZE]))
+    return keys
+
+
+def seed(rng, beers, users, reviews, favorites):
+    """Writes the dataset and the derived entities (name index, summaries, leaderboards, stats, neighbours)"""
+    from auth import hash_password, index_user_name
+    from beer_api import Beer, name_index
+    from beer_glass_api import BeerGlass
+    from beer_review_api import BeerReview
+    from favorites_api import Favorites, favorite_key
+    from leaderboard import update_leaderboards
+    from review_summary import SCORE_FIELDS, BeerReviewSummary, BeerReviewSummaryShard, shard_keys, summary_values
+    from user_api import User, seed_admin
+    from user_stats import UserStats, stats_key
+
+    seed_admin()
+    glass_keys = put_batched([BeerGlass(name='Glass %d' % i, description='seeded glass', capacity=8.0 + i)
+                              for i in range(20)])
+
+    beer_entities = [Beer(name='%s %s %05d' % (rng.choice(WORDS), rng.choice(WORDS), i),
+                          description='seeded beer %d' % i,
+                          ibu=float(rng.randint(5, 120)),
+                          calories=float(rng.randint(90, 350)),
+                          abv=round(rng.uniform(2.5, 14.0), 1),
+                          style=rng.choice(STYLES),
+                          brewery_location='Brewery %d' % rng.randint(1, 500),
+                          beer_glass=rng.choice(glass_keys))
+                     for i in range(beers)]
+    beer_keys = put_batched(beer_entities)
+    put_batched([name_index(b) for b in beer_entities])
+
+    # one hash for every seeded user, hashing is deliberately slow
+    password = hash_password(PASSWORD)
+    user_entities = [User(user_name='user%05d' % i, first_name='First%d' % i, last_name='Last%d' % i,
+                          password=password)
+                     for i in range(users)]
+    user_keys = put_batched(user_entities)
+    put_batched([index_user_name(u) for u in user_entities])
+
+    pairs = set()
+    while len(pairs) < min(reviews, beers * users):
+        pairs.add((rng.randrange(users), rng.randrange(beers)))
+    review_entities = []
+    for user_index, beer_index in sorted(pairs):
+        scores = dict((f, float(rng.randint(1, 5))) for f in SCORE_FIELDS if f != 'overall')
+        review_entities.append(BeerReview(beer=beer_keys[beer_index], user=user_keys[user_index],
+                                          overall=sum(scores.values()) / len(scores), **scores))
+    review_keys = put_batched(review_entities)
+
+    # summaries and stats are written the way the fold tasks leave them, in bulk
+    beer_sums = defaultdict(lambda: dict((f, 0.0) for f in SCORE_FIELDS + ('count',)))
+    user_sums = defaultdict(lambda: dict((f, 0.0) for f in SCORE_FIELDS + ('count',)))
+    for r in review_entities:
+        for sums in (beer_sums[BeerReview.beer.get_value_for_datastore(r)],
+                     user_sums[BeerReview.user.get_value_for_datastore(r)]):
+            sums['count'] += 1
+            for f in SCORE_FIELDS:
+                sums[f] += getattr(r, f)
+    styles = dict((k, b.style) for k, b in zip(beer_keys, beer_entities))
+    shards, summaries, values = [], [], {}
+    for beer_key, sums in beer_sums.items():
+        shards.append(BeerReviewSummaryShard(key=shard_keys(beer_key)[0], beer=beer_key, count=int(sums['count']),
+                                             **dict((f, sums[f]) for f in SCORE_FIELDS)))
+        summaries.append(BeerReviewSummary(key_name=str(beer_key.id()), beer=beer_key, style=styles[beer_key],
+                                           count=int(sums['count']),
+                                           **dict((f, sums[f] / sums['count']) for f in SCORE_FIELDS)))
+        values[beer_key] = summary_values(summaries[-1])
+    put_batched(shards)
+    put_batched(summaries)
+    items = values.items()
+    for i in range(0, len(items), PUT_BATCH_SIZE):
+        update_leaderboards(dict(items[i:i + PUT_BATCH_SIZE]))
+
+    favorite_pairs = set()
+    while len(favorite_pairs) < min(favorites, beers * users):
+        favorite_pairs.add((rng.randrange(users), rng.randrange(beers)))
+    favorite_counts = defaultdict(int)
+    favorite_entities = []
+    for user_index, beer_index in sorted(favorite_pairs):
+        user_key, beer_key = user_keys[user_index], beer_keys[beer_index]
+        favorite_entities.append(Favorites(key=favorite_key(user_key, beer_key.id()), user=user_key, beer=beer_key))
+        favorite_counts[user_key] += 1
+    put_batched(favorite_entities)
+
+    stats = []
+    for user_key in set(user_sums) | set(favorite_counts):
+        sums = user_sums.get(user_key, {})
+        stats.append(UserStats(key=stats_key(user_key), review_count=int(sums.get('count', 0)),
+                               favorite_count=favorite_counts.get(user_key, 0),
+                               **dict((f + '_sum', sums.get(f, 0.0)) for f in SCORE_FIELDS)))
+    put_batched(stats)
+
+    try:
+        from recommendations import rebuild_neighbors
+        rebuild_neighbors()
+    except ImportError:
+        # recommendations are served empty without numpy
+        pass
+
+    return {'beer_glasses': [k.id() for k in glass_keys],
+            'beers': [k.id() for k in beer_keys],
+            'users': [k.id() for k in user_keys],
+            'user_names': dict((k.id(), u.user_name) for k, u in zip(user_keys, user_entities)),
+            'reviews': [k.id() for k in review_keys],
+            'favorites': [(user_keys[u].id(), beer_keys[b].id()) for u, b in sorted(favorite_pairs)]}
+
+
+class Pool(object):
+    """Ids the request mix picks from, writes add to it and deletes take from it"""
+
+    def __init__(self, items):
+        self.items = list(items)
+        self.lock = threading.Lock()
+
+    def pick(self, rng):
+        with self.lock:
+            return rng.choice(self.items) if self.items else 0
+
+    def add(self, item):
+        with self.lock:
+            self.items.append(item)
+
+    def take(self, rng):
+        with self.lock:
+            if not self.items:
+                return 0
+            return self.items.pop(rng.randrange(len(self.items)))
+
+
+def uri_id(data, name):
+    return int(data[name]['uri'].rsplit('/', 1)[1])
+
+
+def review_body(rng):
+    return dict((f, float(rng.randint(1, 5))) for f in ('aroma', 'appearance', 'taste', 'palate', 'bottle_style'))
+
+
+def new_beer(rng, ctx):
+    return {'name': 'Load %s %d' % (rng.choice(WORDS), rng.randint(0, 10 ** 9)), 'style': rng.choice(STYLES),
+            'abv': round(rng.uniform(2.5, 14.0), 1), 'ibu': float(rng.randint(5, 120)),
+            'beer_glass_id': ctx['beer_glasses'].pick(rng)}
+
+
+def build_mix(ctx):
+    """(weight, method, endpoint, auth, request builder, response hook) for every route and method
+
+    auth is 'user' (a random seeded user's token), 'admin' or 'task' (the task queue header). Builders
+    return (path, json body or None).
+    """
+    pools = ctx
+    api = '/api/v1.0'
+
+    def added(pool, name):
+        return lambda data: pools[pool].add(uri_id(data, name))
+
+    def added_favorite(data):
+        user_id, beer_id = data['favorite']['uri'].rsplit('/', 1)[1].split('_')
+        pools['favorites'].add((int(user_id), int(beer_id)))
+
+    def ids(rng, pool, n):
+        return ','.join(str(pools[pool].pick(rng)) for _ in range(n))
+
+    return [
+        (4, 'POST', 'token', 'basic', lambda rng: ('%s/token' % api, None), None),
+        (3, 'GET', 'users', 'user', lambda rng: (rng.choice([
+            '%s/users?limit=20' % api,
+            '%s/users?ids=%s' % (api, ids(rng, 'users', 20))]), None), None),
+        (1, 'POST', 'users', 'user', lambda rng: ('%s/users' % api, {
+            'user_name': 'load%d' % rng.randint(0, 10 ** 9), 'first_name': 'Load', 'last_name': 'Test',
+            'password': PASSWORD}), added('created_users', 'user')),
+        (6, 'GET', 'user', 'user', lambda rng: ('%s/users/%d' % (api, pools['users'].pick(rng)), None), None),
+        (1, 'PUT', 'user', 'user', lambda rng: ('%s/users/%d' % (api, pools['created_users'].pick(rng)),
+                                                {'first_name': 'Renamed'}), None),
+        (1, 'DELETE', 'user', 'user', lambda rng: ('%s/users/%d' % (api, pools['created_users'].take(rng)), None),
+         None),
+        (5, 'GET', 'user_reviews', 'user', lambda rng: (
+            '%s/users/%d/reviews%s' % (api, pools['users'].pick(rng), rng.choice(['', '?type=summary'])), None),
+         None),
+        (4, 'GET', 'user_recommendations', 'user', lambda rng: (
+            '%s/users/%d/recommendations' % (api, pools['users'].pick(rng)), None), None),
+        (2, 'GET', 'beer_glasses', 'user', lambda rng: ('%s/beer_glasses' % api, None), None),
+        (1, 'POST', 'beer_glasses', 'user', lambda rng: ('%s/beer_glasses' % api, {
+            'name': 'Load glass %d' % rng.randint(0, 10 ** 9), 'capacity': 12.0}),
+         added('created_glasses', 'beer_glass')),
+        (2, 'GET', 'beer_glass', 'user', lambda rng: (
+            '%s/beer_glasses/%d' % (api, pools['beer_glasses'].pick(rng)), None), None),
+        (1, 'PUT', 'beer_glass', 'user', lambda rng: (
+            '%s/beer_glasses/%d' % (api, pools['created_glasses'].pick(rng)), {'capacity': 16.0}), None),
+        (1, 'DELETE', 'beer_glass', 'user', lambda rng: (
+            '%s/beer_glasses/%d' % (api, pools['created_glasses'].take(rng)), None), None),
+        (1, 'POST', 'beer_glasses_bulk', 'admin', lambda rng: ('%s/beer_glasses/bulk' % api, [
+            {'name': 'Bulk glass %d' % rng.randint(0, 10 ** 9)} for _ in range(10)]), None),
+        (12, 'GET', 'beers', 'user', lambda rng: (rng.choice([
+            '%s/beers?limit=20' % api,
+            '%s/beers?sort=name&limit=50' % api,
+            '%s/beers?style=%s&sort=abv&order=desc' % (api, rng.choice(STYLES)),
+            '%s/beers?min_abv=8&limit=20&fields=name,abv' % api,
+            '%s/beers?ids=%s' % (api, ids(rng, 'beers', 20))]), None), None),
+        (2, 'POST', 'beers', 'admin', lambda rng: ('%s/beers' % api, new_beer(rng, pools)),
+         added('created_beers', 'beer')),
+        (15, 'GET', 'beer', 'user', lambda rng: ('%s/beers/%d' % (api, pools['beers'].pick(rng)), None), None),
+        (1, 'PUT', 'beer', 'admin', lambda rng: (
+            '%s/beers/%d' % (api, pools['created_beers'].pick(rng)), {'abv': 5.5}), None),
+        (1, 'DELETE', 'beer', 'admin', lambda rng: (
+            '%s/beers/%d' % (api, pools['created_beers'].take(rng)), None), None),
+        (1, 'POST', 'beers_bulk', 'admin', lambda rng: ('%s/beers/bulk' % api, [
+            new_beer(rng, pools) for _ in range(20)]), None),
+        (6, 'GET', 'leaderboard', 'user', lambda rng: ('%s/beers/top?sort=%s%s' % (
+            api, rng.choice(['overall', 'taste', 'aroma']), rng.choice(['', '&style=' + rng.choice(STYLES)])),
+            None), None),
+        (8, 'GET', 'beer_search', 'user', lambda rng: ('%s/beers/search?q=%s' % (
+            api, rng.choice(WORDS)[:rng.randint(2, 5)]), None), None),
+        (8, 'GET', 'beer_reviews', 'user', lambda rng: ('%s/beers/%d/reviews%s' % (
+            api, pools['beers'].pick(rng), rng.choice(['', '?type=summary', '?sort=overall&order=desc'])), None),
+         None),
+        (3, 'POST', 'beer_reviews', 'user', lambda rng: (
+            '%s/beers/%d/reviews' % (api, pools['beers'].pick(rng)), review_body(rng)), None),
+        (4, 'GET', 'reviews', 'user', lambda rng: (rng.choice([
+            '%s/beer_reviews?limit=20' % api,
+            '%s/beer_reviews?type=summary&limit=20' % api,
+            '%s/beer_reviews?min_overall=4&limit=20' % api,
+            '%s/beer_reviews?ids=%s' % (api, ids(rng, 'reviews', 20))]), None), None),
+        (2, 'POST', 'reviews', 'user', lambda rng: ('%s/beer_reviews' % api, dict(
+            review_body(rng), beer_id=pools['beers'].pick(rng))), None),
+        (6, 'GET', 'review', 'user', lambda rng: ('%s/beer_reviews/%d' % (api, pools['reviews'].pick(rng)), None),
+         None),
+        (1, 'POST', 'reviews_bulk', 'admin', lambda rng: ('%s/beer_reviews/bulk' % api, [
+            dict(review_body(rng), beer_id=pools['beers'].pick(rng), user_id=pools['users'].pick(rng))
+            for _ in range(20)]), None),
+        (5, 'GET', 'user_favorites', 'user', lambda rng: (
+            '%s/users/%d/favorites' % (api, pools['users'].pick(rng)), None), None),
+        (4, 'GET', 'beer_favorites', 'user', lambda rng: (
+            '%s/beers/%d/favorites' % (api, pools['beers'].pick(rng)), None), None),
+        (2, 'POST', 'beer_favorites', 'user', lambda rng: (
+            '%s/beers/%d/favorites' % (api, pools['beers'].pick(rng)), None), added_favorite),
+        (1, 'DELETE', 'beer_favorites', 'user', lambda rng: (
+            '%s/beers/%d/favorites' % (api, pools['beers'].pick(rng)), None), None),
+        (4, 'GET', 'favorites', 'user', lambda rng: (
+            '%s/favorites?beer_ids=%s' % (api, ids(rng, 'beers', 20)), None), None),
+        (2, 'POST', 'favorites', 'user', lambda rng: (
+            '%s/favorites' % api, {'beer_id': pools['beers'].pick(rng)}), added_favorite),
+        (3, 'GET', 'favorite', 'user', lambda rng: (
+            '%s/favorites/%d_%d' % ((api,) + (pools['favorites'].pick(rng) or (0, 0))), None), None),
+        (1, 'DELETE', 'favorite', 'user', lambda rng: (
+            '%s/favorites/%d_%d' % ((api,) + (pools['favorites'].take(rng) or (0, 0))), None), None),
+        (1, 'POST', 'admin_job', 'admin', lambda rng: (
+            '%s/admin/jobs/%s' % (api, rng.choice(['favorite_keys', 'beer_name_index'])), None), None),
+        (1, 'GET', 'stats', 'admin', lambda rng: ('%s/_stats' % api, None), None),
+        (2, 'POST', 'fold_review_summary', 'task', lambda rng: (
+            '/_tasks/review_summary/fold', {'beer_id': pools['beers'].pick(rng)}), None),
+        (0.2, 'GET', 'sweep_review_summary', 'task', lambda rng: ('/_tasks/review_summary/sweep', None), None),
+        (1, 'POST', 'fold_user_stats', 'task', lambda rng: (
+            '/_tasks/user_stats/fold', {'user_id': pools['users'].pick(rng)}), None),
+        (1, 'GET', 'update_leaderboards', 'task', lambda rng: ('/_tasks/leaderboards/update', None), None),
+        (0.05, 'GET', 'rebuild_recommendations', 'task', lambda rng: ('/_tasks/recommendations/rebuild', None),
+         None),
+        (0.5, 'GET', 'bootstrap', 'task', lambda rng: (rng.choice(['/_ah/warmup', '/_tasks/bootstrap']), None),
+         None),
+    ]
+
+
+def basic(user_name, password):
+    return 'Basic ' + base64.b64encode('%s:%s' % (user_name, password))
+
+
+def issue_tokens(client, data, rng):
+    """Bearer tokens for the admin and CLIENT_USERS seeded users, so most requests skip password checks"""
+    def token(user_name, password):
+        response = client.post('/api/v1.0/token', headers={'Authorization': basic(user_name, password)})
+        return 'Bearer ' + json.loads(response.data)['token']
+
+    users = rng.sample(data['users'], min(CLIENT_USERS, len(data['users'])))
+    return (token('admin', ADMIN_PASSWORD),
+            [(data['user_names'][u], token(data['user_names'][u], PASSWORD)) for u in users])
+
+
+def percentile(timings, p):
+    if not timings:
+        return None
+    return round(timings[min(len(timings) - 1, int(p * len(timings)))], 2)
+
+
+def run(app, mix, admin_token, client_tokens, requests, threads, rng_seed, counter):
+    weights = [m[0] for m in mix]
+    plan_rng = random.Random(rng_seed)
+    total = sum(weights)
+    # the whole mix is drawn up front so every run with the same seed issues the same requests
+    plan = []
+    for _ in range(requests):
+        x, i = plan_rng.uniform(0, total), 0
+        while x > weights[i] and i < len(weights) - 1:
+            x -= weights[i]
+            i += 1
+        plan.append(i)
+
+    results = defaultdict(list)
+    lock = threading.Lock()
+    position = [0]
+
+    def worker(worker_id):
+        rng = random.Random('%s-%d' % (rng_seed, worker_id))
+        client = app.test_client()
+        while True:
+            with lock:
+                if position[0] >= len(plan):
+                    return
+                i = plan[position[0]]
+                position[0] += 1
+            weight, method, endpoint, auth, build, hook = mix[i]
+            path, body = build(rng)
+            headers = {}
+            user_name, token = rng.choice(client_tokens)
+            if auth == 'user':
+                headers['Authorization'] = token
+            elif auth == 'basic':
+                headers['Authorization'] = basic(user_name, PASSWORD)
+            elif auth == 'admin':
+                headers['Authorization'] = admin_token
+            elif auth == 'task':
+                headers['X-AppEngine-QueueName'] = 'load-test'
+            rpcs = counter.count()
+            start = time.time()
+            response = client.open(path, method=method, headers=headers,
+                                   data=json.dumps(body) if body is not None else None,
+                                   content_type='application/json')
+            payload = response.data
+            elapsed = (time.time() - start) * 1000
+            if hook is not None and response.status_code == 200:
+                hook(json.loads(payload))
+            with lock:
+                results['%s %s' % (method, endpoint)].append((elapsed, counter.count() - rpcs, response.status_code))
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return results, time.time() - start
+
+
+def summarize(results, seconds):
+    endpoints = {}
+    for name, samples in sorted(results.items()):
+        timings = sorted(s[0] for s in samples)
+        statuses = defaultdict(int)
+        for s in samples:
+            statuses[str(s[2])] += 1
+        endpoints[name] = {'requests': len(samples),
+                           'requests_per_second': round(len(samples) / seconds, 2),
+                           'p50_ms': percentile(timings, 0.5),
+                           'p95_ms': percentile(timings, 0.95),
+                           'p99_ms': percentile(timings, 0.99),
+                           'datastore_rpcs_per_request': round(float(sum(s[1] for s in samples)) / len(samples), 2),
+                           'status': dict(statuses),
+                           'errors': sum(1 for s in samples if s[2] >= 500)}
+    return endpoints
+
+
+def uncovered_routes(app, mix):
+    """Route and method pairs of beer_manager the mix does not exercise, empty when the mix is complete"""
+    covered = set((m[1], m[2]) for m in mix)
+    missing = []
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == 'static':
+            continue
+        for method in rule.methods - set(['HEAD', 'OPTIONS']):
+            if (method, rule.endpoint) not in covered:
+                missing.append('%s %s' % (method, rule.rule))
+    return sorted(missing)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the dataset sizes below')
+    parser.add_argument('--beers', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--reviews', type=int, default=200000)
+    parser.add_argument('--favorites', type=int, default=200000)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=414)
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    setup_path()
+    datastore_file = tempfile.mktemp(suffix='.sqlite', prefix='load_test_')
+    bed = activate_stubs(datastore_file)
+    try:
+        counter = RpcCounter()
+        counter.install()
+        from beer_manager import app
+
+        rng = random.Random(args.seed)
+        sizes = dict((name, max(1, int(getattr(args, name) * args.scale)))
+                     for name in ('beers', 'users', 'reviews', 'favorites'))
+        start = time.time()
+        data = seed(rng, **sizes)
+        seed_seconds = time.time() - start
+
+        ctx = dict((name, Pool(data[name])) for name in ('beer_glasses', 'beers', 'users', 'reviews', 'favorites'))
+        ctx.update((name, Pool([])) for name in ('created_users', 'created_glasses', 'created_beers'))
+        mix = build_mix(ctx)
+        admin_token, client_tokens = issue_tokens(app.test_client(), data, rng)
+        results, seconds = run(app, mix, admin_token, client_tokens, args.requests, args.threads, args.seed, counter)
+
+        samples = [s for endpoint_samples in results.values() for s in endpoint_samples]
+        timings = sorted(s[0] for s in samples)
+        report = {'revision': git_revision(),
+                  'config': dict(sizes, requests=args.requests, threads=args.threads, seed=args.seed),
+                  'seed_seconds': round(seed_seconds, 2),
+                  'run_seconds': round(seconds, 2),
+                  'total': {'requests': len(samples),
+                            'requests_per_second': round(len(samples) / seconds, 2),
+                            'p50_ms': percentile(timings, 0.5),
+                            'p95_ms': percentile(timings, 0.95),
+                            'p99_ms': percentile(timings, 0.99),
+                            'datastore_rpcs_per_request': round(float(sum(s[1] for s in samples)) / len(samples), 2),
+                            'errors': sum(1 for s in samples if s[2] >= 500)},
+                  'endpoints': summarize(results, seconds),
+                  'uncovered_routes': uncovered_routes(app, mix)}
+    finally:
+        bed.deactivate()
+        if os.path.exists(datastore_file):
+            os.remove(datastore_file)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print output
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    if report['total']['errors'] or report['uncovered_routes']:
+        sys.exit('%d requests failed with a 5xx, %d routes were not exercised' % (report['total']['errors'],
+                                                                               len(report['uncovered_routes'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Compares flask.ext.restful.marshal with the compiled serializer on synthetic beers.
+
+Run from the project root with the App Engine SDK importable (or APPENGINE_SDK pointing at it):
+
+    python benchmarks/marshal_benchmark.py --count 10000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_path():
+    sdk = os.environ.get('APPENGINE_SDK')
+    if sdk:
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path[0:0] = [ROOT, os.path.join(ROOT, 'lib')]
+    os.environ.setdefault('APPLICATION_ID', 'dev~beer-manager-414')
+
+
+def best_of(repeat, f):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        f()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    setup_path()
+    from flask import Flask
+    from flask.ext.restful import marshal
+    from google.appengine.ext import db
+    from beer_api import Beer, beer_fields, marshal_beer
+    from beer_glass_api import BeerGlass
+
+    app = Flask(__name__)
+    app.add_url_rule('/api/v1.0/beers/<int:id>', 'beer')
+    app.add_url_rule('/api/v1.0/beer_glasses/<int:id>', 'beer_glass')
+
+    glasses = [BeerGlass(key=db.Key.from_path('BeerGlass', i + 1), name='glass %d' % i) for i in range(10)]
+    beers = [Beer(key=db.Key.from_path('Beer', i + 1),
+                  name='beer %d' % i,
+                  description='synthetic beer %d' % i,
+                  ibu=float(i % 100),
+                  abv=(i % 120) / 10.0,
+                  style='style %d' % (i % 25),
+                  beer_glass=glasses[i % len(glasses)] if i % 7 else None)
+             for i in range(args.count)]
+
+    with app.test_request_context('/'):
+        expected = [marshal(b, beer_fields) for b in beers]
+        if marshal_beer(beers) != expected:
+            sys.exit('compiled output does not match flask.ext.restful.marshal')
+        restful = best_of(args.repeat, lambda: [marshal(b, beer_fields) for b in beers])
+        compiled = best_of(args.repeat, lambda: marshal_beer(beers))
+
+    print json.dumps({'entities': args.count,
+                      'marshal_seconds': round(restful, 4),
+                      'compiled_seconds': round(compiled, 4),
+                      'speedup': round(restful / compiled, 2)}, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Checks that resolving the references of a list page takes the same number of datastore RPCs for any page size.
+
+Beers and reviews are seeded into the testbed datastore stub, then pages of --small and --large entities
+are fetched and have their references prefetched and marshalled. Datastore RPCs are counted with an
+apiproxy hook from after the fetch, so only reference resolution is compared. Exits non-zero when the
+two page sizes take a different number of RPCs. Run from the project root with the App Engine SDK
+importable (or APPENGINE_SDK pointing at it):
+
+    python benchmarks/prefetch_rpc_check.py --small 10 --large 500
+"""
+import argparse
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_path():
+    sdk = os.environ.get('APPENGINE_SDK')
+    if sdk:
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path[0:0] = [ROOT, os.path.join(ROOT, 'lib')]
+
+
+class RpcCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('prefetch_rpc_check', self.post_call, 'datastore_v3')
+
+    def post_call(self, service, call, rpc_request, rpc_response, rpc=None, error=None):
+        self.count += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--small', type=int, default=10)
+    parser.add_argument('--large', type=int, default=500)
+    args = parser.parse_args()
+
+    setup_path()
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.setup_env(app_id='dev~beer-manager-414', overwrite=True)
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    try:
+        counter = RpcCounter()
+        counter.install()
+        from google.appengine.ext import db
+        from beer_manager import app
+        from beer_api import Beer, marshal_beer
+        from beer_glass_api import BeerGlass
+        from beer_review_api import BeerReview, marshal_review
+        from db_helper import prefetch_references
+        from user_api import User
+
+        glasses = db.put([BeerGlass(name='glass %d' % i) for i in range(10)])
+        users = db.put([User(user_name='user%d' % i, first_name='First', last_name='Last', password='x')
+                        for i in range(10)])
+        beers = db.put([Beer(name='beer %d' % i, beer_glass=glasses[i % len(glasses)]) for i in range(args.large)])
+        db.put([BeerReview(beer=beers[i], user=users[i % len(users)], aroma=3.0, appearance=3.0, taste=3.0,
+                           palate=3.0, bottle_style=3.0, overall=3.0)
+                for i in range(args.large)])
+
+        lists = [('beers', Beer, marshal_beer, [Beer.beer_glass]),
+                 ('beer_reviews', BeerReview, marshal_review, [BeerReview.beer, BeerReview.user])]
+        report = {}
+        with app.test_request_context():
+            for name, model, marshaller, references in lists:
+                report[name] = {}
+                for size in (args.small, args.large):
+                    entities = model.all().fetch(size)
+                    counter.count = 0
+                    marshaller(prefetch_references(entities, *references))
+                    report[name][size] = counter.count
+    finally:
+        bed.deactivate()
+
+    print json.dumps(report, indent=2, sort_keys=True)
+    differing = [name for name, counts in report.items() if counts[args.large] != counts[args.small]]
+    if differing:
+        sys.exit('%s took a different number of datastore RPCs for %d entities than for %d'
+                 % (', '.join(differing), args.large, args.small))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Measures how long a fresh interpreter takes to import beer_manager.app and fails over a budget.
+
+Every run imports the app in a new process with no App Engine API stubs registered, so an import
+that makes a datastore or memcache call fails instead of being timed. Run from the project root with
+the App Engine SDK importable (or APPENGINE_SDK pointing at it):
+
+    python benchmarks/startup_benchmark.py --runs 5 --budget 1.0
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SCRIPT = """
+import os, sys, time
+sdk = os.environ.get('APPENGINE_SDK')
+if sdk:
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+sys.path[0:0] = [%(root)r, os.path.join(%(root)r, 'lib')]
+os.environ.setdefault('APPLICATION_ID', 'dev~beer-manager-414')
+from google.appengine.api import apiproxy_stub_map
+apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+start = time.time()
+from beer_manager import app
+elapsed = time.time() - start
+print elapsed, len(sys.modules)
+"""
+
+
+def import_once():
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT % {'root': ROOT}], cwd=ROOT)
+    seconds, modules = output.split()
+    return float(seconds), int(modules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=1.0, help='seconds the median import may take')
+    args = parser.parse_args()
+
+    runs = [import_once() for _ in range(args.runs)]
+    timings = sorted(seconds for seconds, modules in runs)
+    median = timings[len(timings) / 2]
+    print json.dumps({'runs': args.runs,
+                      'median_seconds': round(median, 4),
+                      'max_seconds': round(timings[-1], 4),
+                      'modules_loaded': runs[-1][1],
+                      'budget_seconds': args.budget}, indent=2)
+    if median > args.budget:
+        sys.exit('import of beer_manager.app took %.3fs, over the %.3fs budget' % (median, args.budget))
+
+
+if __name__ == '__main__':
+    main()
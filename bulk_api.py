@@ -0,0 +1,248 @@
+import datetime
+import json
+from collections import defaultdict
+
+from flask import request
+from flask.ext.restful import Resource, abort
+from google.appengine.ext import db
+
+from auth import requires_admin
+from beer_api import Beer, marshal_beer, name_index
+from beer_glass_api import BeerGlass, marshal_glass
+from beer_review_api import BeerReview, REVIEW_PERIOD, new_review, marshal_review
+from review_summary import pending_scores, schedule_fold
+from throttle import ThrottleMarker, held_until, review_throttle
+from user_api import User
+from user_stats import pending_stats, schedule_stats_folds
+from versioning import bump_version
+
+__author__ = 'wojtowpj'
+
+MAX_BULK_ROWS = 1000
+PUT_CHUNK_SIZE = 500
+# datastore IN filters are limited to 30 values
+IN_FILTER_SIZE = 30
+
+beer_columns = {
+    'name': unicode,
+    'description': unicode,
+    'ibu': float,
+    'calories': float,
+    'abv': float,
+    'style': unicode,
+    'brewery_location': unicode,
+    'beer_glass_id': int,
+}
+
+review_columns = {
+    'beer_id': int,
+    'user_id': int,
+    'aroma': float,
+    'appearance': float,
+    'taste': float,
+    'palate': float,
+    'bottle_style': float,
+    'comments': unicode,
+}
+
+glass_columns = {
+    'name': unicode,
+    'description': unicode,
+    'capacity': float,
+}
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def parse_rows():
+    """Reads the request body as a JSON array or as newline delimited JSON (one object per line)"""
+    body = request.get_data().strip()
+    try:
+        if body.startswith('['):
+            rows = json.loads(body)
+        else:
+            rows = [json.loads(line) for line in body.splitlines() if line.strip()]
+    except ValueError as e:
+        abort(400, message='Invalid JSON: %s' % e)
+    if not rows:
+        abort(400, message='No rows to create')
+    if len(rows) > MAX_BULK_ROWS:
+        abort(400, message='At most %d rows can be created per request' % MAX_BULK_ROWS)
+    return rows
+
+
+def coerce_row(row, columns, required, ids=()):
+    """Returns the row converted to the column types, raises ValueError with a message for bad rows
+
+    The ids columns are checked to be positive, as the datastore cannot build keys of other ids.
+    """
+    if not isinstance(row, dict):
+        raise ValueError('row must be a JSON object')
+    values = {}
+    for column, column_type in columns.items():
+        value = row.get(column)
+        if value is not None:
+            try:
+                value = column_type(value)
+            except (TypeError, ValueError):
+                raise ValueError('%s must be of type %s' % (column, column_type.__name__))
+        values[column] = value
+    for column in required:
+        if values.get(column) is None or values[column] == '':
+            raise ValueError('%s is required' % column)
+    for column in ids:
+        if values.get(column) is not None and values[column] < 1:
+            raise ValueError('%s must be a positive integer' % column)
+    return values
+
+
+def coerce_rows(rows, columns, required=('name',), ids=()):
+    """Returns a result list with the errors of bad rows filled in and (index, values) for the good rows"""
+    results = [None] * len(rows)
+    valid = []
+    for i, row in enumerate(rows):
+        try:
+            valid.append((i, coerce_row(row, columns, required, ids)))
+        except ValueError as e:
+            results[i] = {'row': i, 'status': 400, 'message': str(e)}
+    return results, valid
+
+
+def existing_names(model, names):
+    existing = set()
+    # name cannot be projected, projections exclude properties with equality (and IN) filters
+    for chunk in chunks(list(names), IN_FILTER_SIZE):
+        for entity in model.all().filter('name IN', chunk):
+            existing.add(entity.name)
+    return existing
+
+
+def bulk_create(model, results, valid, build):
+    """Checks name uniqueness for the whole batch and puts the new entities in chunks
+
+    build(values) returns the entity for a row or raises ValueError, results gets the errors filled in, as it
+    does for values the model's properties reject. Returns the created entities with their row index.
+    """
+    taken = existing_names(model, set(values['name'] for i, values in valid))
+    created = []
+    for i, values in valid:
+        if values['name'] in taken:
+            results[i] = {'row': i, 'status': 409, 'message': "Name '%s' already exists" % values['name']}
+            continue
+        try:
+            entity = build(values)
+        except (ValueError, db.BadValueError) as e:
+            results[i] = {'row': i, 'status': 400, 'message': str(e)}
+            continue
+        taken.add(values['name'])
+        created.append((i, entity))
+
+    for chunk in chunks(created, PUT_CHUNK_SIZE):
+        db.put([entity for i, entity in chunk])
+    return created
+
+
+class BeerBulkApi(Resource):
+    @requires_admin
+    def post(self):
+        results, valid = coerce_rows(parse_rows(), beer_columns, ids=('beer_glass_id',))
+        glass_ids = list(set(values['beer_glass_id'] for i, values in valid if values['beer_glass_id']))
+        glasses = dict(zip(glass_ids, BeerGlass.get_by_id(glass_ids))) if glass_ids else {}
+
+        def build(values):
+            glass = None
+            if values['beer_glass_id'] is not None:
+                glass = glasses.get(values['beer_glass_id'])
+                if glass is None:
+                    raise ValueError('Beer glass %d not found' % values['beer_glass_id'])
+            if values['description'] is not None:
+                values['description'] = values['description'][:500]
+            del values['beer_glass_id']
+            return Beer(beer_glass=glass, **values)
+
+        created = bulk_create(Beer, results, valid, build)
+        for chunk in chunks(created, PUT_CHUNK_SIZE):
+            db.put([name_index(beer) for i, beer in chunk])
+        for i, beer in created:
+            results[i] = {'row': i, 'status': 201, 'beer': marshal_beer(beer)}
+        if created:
+            bump_version('Beer')
+        return {'created': len(created), 'results': results}
+
+
+class BeerGlassBulkApi(Resource):
+    @requires_admin
+    def post(self):
+        results, valid = coerce_rows(parse_rows(), glass_columns)
+        created = bulk_create(BeerGlass, results, valid, lambda values: BeerGlass(**values))
+        for i, glass in created:
+            results[i] = {'row': i, 'status': 201, 'beer_glass': marshal_glass(glass)}
+        if created:
+            bump_version('BeerGlass')
+        return {'created': len(created), 'results': results}
+
+
+def get_by_ids(model, ids):
+    ids = list(ids)
+    return dict(zip(ids, model.get_by_id(ids))) if ids else {}
+
+
+class ReviewBulkApi(Resource):
+    @requires_admin
+    def post(self):
+        required = [c for c in review_columns if c != 'comments']
+        results, valid = coerce_rows(parse_rows(), review_columns, required, ids=('beer_id', 'user_id'))
+        beers = get_by_ids(Beer, set(values['beer_id'] for i, values in valid))
+        users = get_by_ids(User, set(values['user_id'] for i, values in valid))
+
+        throttles = {}
+        for i, values in valid:
+            if beers[values['beer_id']] is None:
+                results[i] = {'row': i, 'status': 404, 'message': 'Beer %d not found' % values['beer_id']}
+            elif users[values['user_id']] is None:
+                results[i] = {'row': i, 'status': 404, 'message': 'User %d not found' % values['user_id']}
+            else:
+                throttles[i] = review_throttle(users[values['user_id']].key(), beers[values['beer_id']].key())
+
+        # the weekly review markers of the whole batch are read with one batch get
+        held = held_until(set(throttles.values()))
+        now = datetime.datetime.utcnow()
+        created = []
+        for i, values in valid:
+            name = throttles.get(i)
+            if name is None:
+                continue
+            if name in held:
+                allowed_in = (held[name] - now).total_seconds()
+                results[i] = {'row': i, 'status': 429, 'allowed_in': round(allowed_in),
+                              'message': 'Only one review per user per beer per week allowed.'}
+                continue
+            try:
+                review = new_review(beers[values['beer_id']], users[values['user_id']], values)
+            except db.BadValueError as e:
+                results[i] = {'row': i, 'status': 400, 'message': str(e)}
+                continue
+            held[name] = now + REVIEW_PERIOD
+            created.append((i, review, ThrottleMarker(key_name=name, expires=held[name])))
+
+        # each review is put with its marker and its pending scores, and each chunk with the pending stats of
+        # its users. The fold tasks add them to the summaries and stats, so a request failing after a put leaves
+        # nothing for a retry to count
+        for chunk in chunks(created, PUT_CHUNK_SIZE / 3):
+            user_reviews = defaultdict(list)
+            for i, review, marker in chunk:
+                user_reviews[BeerReview.user.get_value_for_datastore(review)].append(review)
+            db.put([entity for i, review, marker in chunk
+                    for entity in (review, marker, pending_scores(BeerReview.beer.get_value_for_datastore(review),
+                                                                  review))] +
+                   [pending_stats(user_key, reviews) for user_key, reviews in user_reviews.items()])
+
+        for i, review, marker in created:
+            results[i] = {'row': i, 'status': 201, 'beer_review': marshal_review(review)}
+        for beer_key in set(BeerReview.beer.get_value_for_datastore(review) for i, review, marker in created):
+            schedule_fold(beer_key)
+        schedule_stats_folds(set(BeerReview.user.get_value_for_datastore(review) for i, review, marker in created))
+        return {'created': len(created), 'results': results}
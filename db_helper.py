@@ -1,13 +1,63 @@
 __author__ = 'wojtowpj'
 
+import datetime
+import itertools
+import json
+from flask import Response, stream_with_context
 from flask.ext.restful import fields, reqparse, abort
+from google.appengine.ext import db
+
+import entity_cache
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+STREAM_BATCH_SIZE = 200
+MAX_IDS = 100
+
+# mirrors index.yaml, kind -> composite indexes as property names, '-' marks a descending last property
+COMPOSITE_INDEXES = {
+    'Beer': [
+        ('style', 'name'),
+        ('style', 'abv'),
+        ('style', '-abv'),
+        ('style', 'ibu'),
+        ('style', '-ibu'),
+    ],
+    'BeerNameIndex': [
+        ('prefixes', 'sort_name'),
+    ],
+    'BeerReview': [
+        ('beer', 'date_created'),
+        ('beer', '-date_created'),
+        ('beer', 'overall'),
+        ('beer', '-overall'),
+        ('beer', 'taste'),
+        ('beer', '-taste'),
+        ('user', 'date_created'),
+        ('user', '-date_created'),
+        ('user', 'aroma'),
+        ('user', 'overall'),
+        ('user', '-overall'),
+    ],
+    'BeerReviewSummary': [
+        ('style', '-aroma'),
+        ('style', '-appearance'),
+        ('style', '-taste'),
+        ('style', '-palate'),
+        ('style', '-bottle_style'),
+        ('style', '-overall'),
+    ],
+    'Favorites': [
+        ('user', 'beer'),
+    ],
+}
 
 
 class IdUrlField(fields.Url):
     def output(self, key, obj):
         if obj is None or obj.key() is None:
             return None
-        return super(IdUrlField, self).output(key, {'id': obj.key().id()})
+        return super(IdUrlField, self).output(key, {'id': obj.key().id_or_name()})
 
 
 class ReferenceUrlField(fields.Url):
@@ -17,7 +67,7 @@ class ReferenceUrlField(fields.Url):
         ref = getattr(obj, key)
         if ref is None or ref.key() is None:
             return None
-        return super(ReferenceUrlField, self).output(key, {'id': ref.key().id()})
+        return super(ReferenceUrlField, self).output(key, {'id': ref.key().id_or_name()})
 
 
 def update_model(model, *values, **kwargs):
@@ -28,20 +78,242 @@ def update_model(model, *values, **kwargs):
     for key in kwargs:
         setattr(model, key, kwargs[key])
 
+def prefetch_references(entities, *properties):
+    """Resolves the given ReferenceProperties of all entities with one batch get"""
+    references = [(e, prop, prop.get_value_for_datastore(e)) for e in entities for prop in properties]
+    keys = set(key for e, prop, key in references if key is not None)
+    resolved = dict((r.key(), r) for r in db.get(list(keys)) if r is not None)
+    for entity, prop, key in references:
+        if key in resolved:
+            prop.__set__(entity, resolved[key])
+    return entities
+
 sort_parser = reqparse.RequestParser()
 sort_parser.add_argument('sort', type=str, location='args')
 sort_parser.add_argument('order', type=str, location='args')
+sort_parser.add_argument('limit', type=int, location='args')
+sort_parser.add_argument('cursor', type=str, location='args')
+sort_parser.add_argument('stream', type=str, location='args')
+sort_parser.add_argument('fields', type=str, location='args')
+sort_parser.add_argument('ids', type=str, location='args')
+
+def datetime_arg(value):
+    for date_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError('"%s" is not a YYYY-MM-DD date or YYYY-MM-DDTHH:MM:SS time' % value)
+
+
+def has_index(kind, equality, order):
+    """True when a composite index serves equality filters on the equality properties sorted by order"""
+    indexes = COMPOSITE_INDEXES.get(kind, ())
+    return any(set(index[:-1]) == set(equality) and index[-1] == order for index in indexes)
+
+
+class KeyEntity(object):
+    """Stands in for an entity read by a keys only query, only its key can be marshalled"""
+    def __init__(self, key):
+        self._key = key
+
+    def key(self):
+        return self._key
+
 
-def generate_sorted_query(model):
+def _is_plain_field(field):
+    if isinstance(field, type):
+        field = field()
+    return isinstance(field, fields.Raw) and not isinstance(field, (fields.Nested, fields.Url)) \
+        and field.attribute is None
+
+
+def narrow(marshaller):
+    """Returns marshaller narrowed to the comma separated fields argument, 400 for unknown field names"""
+    names = sort_parser.parse_args().fields
+    if not names:
+        return marshaller
+    names = [n.strip() for n in names.split(',') if n.strip()]
+    unknown = [n for n in names if n not in marshaller.fields]
+    if unknown:
+        abort(400, message='Unknown fields %s, available fields are %s' % (', '.join(unknown),
+                                                                           ', '.join(sorted(marshaller.fields))))
+    return marshaller.subset(names)
+
+
+def projection_for(marshaller, model):
+    """The indexed properties the marshaller's fields read, ('__key__',) when it only needs keys
+
+    Returns None when a field needs the whole entity, references and unindexed properties can't be projected.
+    """
+    projection = []
+    properties = model.properties()
+    for name, field in marshaller.fields.items():
+        if isinstance(field, IdUrlField):
+            continue
+        prop = properties.get(name)
+        if prop is None or not prop.indexed or isinstance(prop, (db.ReferenceProperty, db.ListProperty)) \
+                or not _is_plain_field(field):
+            return None
+        projection.append(name)
+    return tuple(projection) or ('__key__',)
+
+
+def generate_sorted_query(model, filters=None, projection=None, **equality):
+    """Builds a query from the sort and order arguments, the declared filters and the equality filters
+
+    filters maps query argument names to (property, operator, type), equality holds the filters the
+    handler always applies. Combinations no index serves are rejected with 400 before the query runs.
+    A projection from projection_for turns the query into a keys only or projection query when the
+    indexes allow it.
+    """
     args = sort_parser.parse_args()
-    query = model.all()
+    query_filters = []
+    equals = set()
+    ranges = set()
+    for prop, value in equality.items():
+        query_filters.append((prop, value))
+        equals.add(prop)
+
+    if filters:
+        filter_parser = reqparse.RequestParser()
+        for name, (prop, operator, arg_type) in filters.items():
+            filter_parser.add_argument(name, type=arg_type, location='args')
+        values = filter_parser.parse_args()
+        for name, (prop, operator, arg_type) in sorted(filters.items()):
+            if values[name] is None:
+                continue
+            if operator == '=':
+                query_filters.append((prop, values[name]))
+                equals.add(prop)
+            else:
+                query_filters.append(('%s %s' % (prop, operator), values[name]))
+                ranges.add(prop)
+    if len(ranges) > 1:
+        abort(400, message='Range filters can only be applied to one property, got %s' % ', '.join(sorted(ranges)))
+
+    order = None
     if args.sort:
         if not hasattr(model, args.sort):
             abort(400, message='Cannot sort on "%s" property, invalid property name' % args.sort)
         order = args.sort
         if args.order == 'desc':
             order = '-%s' % order
-        query.order(order)
+    if ranges:
+        range_prop = ranges.pop()
+        if order is None:
+            order = range_prop
+        elif order.lstrip('-') != range_prop:
+            abort(400, message='Results filtered on a range of "%s" must be sorted on it' % range_prop)
+
+    if equals and order is not None and not has_index(model.kind(), equals, order):
+        abort(400, message='Filtering on %s and sorting on "%s" is not supported' % (', '.join(sorted(equals)),
+                                                                                     order.lstrip('-')))
 
+    if projection == ('__key__',):
+        query = model.all(keys_only=True)
+    elif projection is not None and len(projection) == 1 and _projectable(model, projection[0], equals, order):
+        query = db.Query(model, projection=projection)
+    else:
+        query = model.all()
+    for condition, value in query_filters:
+        query.filter(condition, value)
+    if order is not None:
+        query.order(order)
     return query
 
+
+def _projectable(model, prop, equals, order):
+    # a single property projection reads the index the query scans anyway, other indexes are not declared
+    if order is not None and order.lstrip('-') != prop:
+        return False
+    return not equals or has_index(model.kind(), equals, order or prop)
+
+
+def fetch_page(query):
+    """Fetches the page of query selected by the limit and cursor arguments, returns (entities, next_cursor)"""
+    args = sort_parser.parse_args()
+    limit = DEFAULT_PAGE_SIZE if args.limit is None else args.limit
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400, message='limit must be between 1 and %d' % MAX_PAGE_SIZE)
+    try:
+        if args.cursor:
+            query.with_cursor(args.cursor)
+        entities = query.fetch(limit)
+    except (db.BadValueError, db.BadRequestError):
+        abort(400, message='Invalid cursor "%s"' % args.cursor)
+    next_cursor = query.cursor() if len(entities) == limit else None
+    if query.is_keys_only():
+        entities = [KeyEntity(k) for k in entities]
+    return entities, next_cursor
+
+
+
+def stream_requested():
+    return sort_parser.parse_args().stream in ('1', 'true')
+
+
+def stream_list(name, query, marshaller, *references):
+    """Returns a response that writes every entity of query as a JSON list under name, one batch at a time"""
+    def generate():
+        yield '{"%s": [' % name
+        separator = ''
+        results = query.run(batch_size=STREAM_BATCH_SIZE)
+        while True:
+            batch = list(itertools.islice(results, STREAM_BATCH_SIZE))
+            if not batch:
+                break
+            if query.is_keys_only():
+                batch = [KeyEntity(k) for k in batch]
+            prefetch_references(batch, *references)
+            yield separator + ','.join(json.dumps(m) for m in marshaller(batch))
+            separator = ','
+        yield ']}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def list_response(name, model, marshaller, references=(), filters=None, **equality):
+    """Returns a page (or the stream) of model entities as name, narrowed to the fields argument
+
+    Only the references whose fields are returned are resolved, fields that only read indexed
+    properties are served from a keys only or projection query.
+    """
+    marshaller = narrow(marshaller)
+    query = generate_sorted_query(model, filters, projection_for(marshaller, model), **equality)
+    references = [r for r in references if r.name in marshaller.fields]
+    if stream_requested():
+        return stream_list(name, query, marshaller, *references)
+    entities, next_cursor = fetch_page(query)
+    prefetch_references(entities, *references)
+    return {name: marshaller(entities), 'next_cursor': next_cursor}
+
+
+def requested_ids():
+    """Returns the ids of the comma separated ids argument without repeats, None when it is not given"""
+    value = sort_parser.parse_args().ids
+    if value is None:
+        return None
+    try:
+        ids = [int(i) for i in value.split(',') if i.strip()]
+    except ValueError:
+        ids = None
+    if ids is None or any(i < 1 for i in ids):
+        abort(400, message='ids must be a comma separated list of positive integers')
+    if not 0 < len(ids) <= MAX_IDS:
+        abort(400, message='Between 1 and %d ids can be requested at once' % MAX_IDS)
+    seen = set()
+    return [i for i in ids if not (i in seen or seen.add(i))]
+
+
+def ids_response(name, model, marshaller, ids, references=()):
+    """Returns the model entities with the given ids in the order requested, narrowed to the fields argument
+
+    The entities are read with one batch get through the entity cache, ids without an entity are
+    listed under missing_ids.
+    """
+    marshaller = narrow(marshaller)
+    entities = entity_cache.get([db.Key.from_path(model.kind(), i) for i in ids])
+    found = [e for e in entities if e is not None]
+    prefetch_references(found, *[r for r in references if r.name in marshaller.fields])
+    return {name: marshaller(found), 'missing_ids': [i for i, e in zip(ids, entities) if e is None]}
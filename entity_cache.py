@@ -0,0 +1,93 @@
+import threading
+from contextlib import contextmanager
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db
+
+from cache import TtlCache
+
+__author__ = 'wojtowpj'
+
+MEMCACHE_TIME = 3600
+# invalidation only reaches this instance's local cache, so its ttl bounds how stale other instances can be
+LOCAL_CACHE_SIZE = 1000
+LOCAL_CACHE_TTL = 5
+# after an invalidation memcache refuses adds for this long, so a reader that loaded the old entity
+# just before the write cannot put it back into the cache
+INVALIDATION_LOCK_SECONDS = 2
+
+_local_cache = TtlCache(max_size=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL)
+_context = threading.local()
+
+
+def _cache_key(key):
+    return 'entity:%s' % key
+
+
+def _serialize(entity):
+    return db.model_to_protobuf(entity).Encode()
+
+
+def _deserialize(data):
+    return db.model_from_protobuf(entity_pb.EntityProto(data))
+
+
+@contextmanager
+def skip_local_cache():
+    """Reads in the block skip this instance's cache, which other instances' writes do not invalidate"""
+    _context.skip_local = True
+    try:
+        yield
+    finally:
+        _context.skip_local = False
+
+
+def get(keys):
+    """Gets entities by key from the local cache, then memcache, then the datastore, None for missing ones
+
+    Entities are cached as encoded protobufs, every call returns fresh instances that are safe to modify.
+    """
+    found = {}
+    if not getattr(_context, 'skip_local', False):
+        for key in keys:
+            data = _local_cache.get(key)
+            if data is not None:
+                found[key] = data
+
+    missing = [k for k in keys if k not in found]
+    if missing:
+        cached = memcache.get_multi(map(_cache_key, missing))
+        for key in missing:
+            data = cached.get(_cache_key(key))
+            if data is not None:
+                found[key] = data
+                _local_cache.set(key, data)
+
+    missing = [k for k in keys if k not in found]
+    if missing:
+        loaded = {}
+        for key, entity in zip(missing, db.get(missing)):
+            if entity is not None:
+                found[key] = loaded[_cache_key(key)] = _serialize(entity)
+                _local_cache.set(key, found[key])
+        if loaded:
+            memcache.add_multi(loaded, time=MEMCACHE_TIME)
+
+    return [_deserialize(found[k]) if k in found else None for k in keys]
+
+
+def get_by_id(model, id):
+    return get([db.Key.from_path(model.kind(), id)])[0]
+
+
+def local_cache_stats():
+    return _local_cache.stats()
+
+
+def invalidate(*entities):
+    """Drops entities (or keys) from both cache tiers, call after every put or delete"""
+    keys = [e if isinstance(e, db.Key) else e.key() for e in entities]
+    for key in keys:
+        _local_cache.delete(key)
+    memcache.delete_multi(map(_cache_key, keys), seconds=INVALIDATION_LOCK_SECONDS)
@@ -1,19 +1,48 @@
-from google.appengine.ext.db import Key
-
 __author__ = 'wojtowpj'
 
 from beer_api import Beer
 from user_api import User
-from auth import requires_auth, get_user
-from db_helper import IdUrlField, generate_sorted_query
-from flask.ext.restful import Resource, fields, reqparse, marshal, abort
+from auth import requires_auth, get_user, get_user_key
+from admin_api import admin_job, job_finished, JOB_BATCH_SIZE
+import entity_cache
+from user_stats import update_stats
+from serializer import compile_fields
+from db_helper import IdUrlField, list_response, narrow
+from flask.ext.restful import Resource, fields, reqparse, abort
 from google.appengine.ext import db
 
 
+MAX_LOOKUP_IDS = 100
+
+
 class Favorites(db.Model):
+    """A user's favorite beer, key_name is '<user id>_<beer id>' (favorites created before that have an id)"""
     beer = db.ReferenceProperty(Beer)
     user = db.ReferenceProperty(User)
 
+
+def favorite_key(user_key, beer_id):
+    return db.Key.from_path('Favorites', '%d_%d' % (user_key.id(), beer_id))
+
+
+def favorite_key_from_id(id):
+    if id.isdigit():
+        if int(id) < 1:
+            abort(404)
+        return db.Key.from_path('Favorites', int(id))
+    return db.Key.from_path('Favorites', id)
+
+
+def legacy_favorite(user, beer_key):
+    """Finds the user's favorite of the beer created before the favorite_keys migration gave it a key_name
+
+    Once the migration has finished there are none left and no query is run.
+    """
+    if job_finished('favorite_keys'):
+        return None
+    return Favorites.all().filter('user', user).filter('beer', beer_key).get()
+
+
 beer_summary_fields = {
     'name': fields.String,
     'uri': IdUrlField('beer', absolute=True),
@@ -29,56 +58,61 @@ favorite_fields = {
     'user': fields.Nested(user_summary_fields),
     'uri': IdUrlField('favorite', absolute=True),
 }
+marshal_favorite = compile_fields(favorite_fields)
 
 favorite_user_fields = {
     'beer': fields.Nested(beer_summary_fields),
     'uri': IdUrlField('favorite', absolute=True),
 }
+marshal_favorite_user = compile_fields(favorite_user_fields)
 
 favorite_beer_fields = {
     'beer': fields.Nested(beer_summary_fields),
     'uri': IdUrlField('favorite', absolute=True),
     }
+marshal_favorite_beer = compile_fields(favorite_beer_fields)
 
 
 class FavoritesListApi(Resource):
     def __init__(self):
         self.postparse = reqparse.RequestParser()
         self.postparse.add_argument('beer_id', type=int, required=True, help='beer_id is required')
+        self.getparse = reqparse.RequestParser()
+        self.getparse.add_argument('beer_ids', type=str, location='args')
 
         super(FavoritesListApi, self).__init__()
 
     @requires_auth
     def get(self):
-        favorites = []
+        args = self.getparse.parse_args()
+        if args.beer_ids is not None:
+            return lookup_favorites(args.beer_ids)
         u = get_user()
         if u is None:
             abort(404, message="User not found")
-        for f in generate_sorted_query(Favorites).filter('user', u):
-            favorites.append(f)
-        return {'favorites': map(lambda f: marshal(f, favorite_fields), favorites)}
+        return list_response('favorites', Favorites, marshal_favorite, [Favorites.beer, Favorites.user], user=u)
 
     @requires_auth
     def post(self):
         args = self.postparse.parse_args()
-        return add_favorite(args.user_id, args.beer_id)
+        return add_favorite(args.beer_id)
 
 
 class FavoritesApi(Resource):
     @requires_auth
     def get(self, id):
-        f = Favorites.get_by_id(id)
+        f = entity_cache.get([favorite_key_from_id(id)])[0]
         if f is None:
             abort(404)
-        return {'favorite': marshal(f, favorite_fields)}
+        return {'favorite': narrow(marshal_favorite)(f)}
 
     @requires_auth
     def delete(self, id):
-        f = Favorites.get_by_id(id)
+        f = Favorites.get(favorite_key_from_id(id))
         if f is None:
             abort(404)
-        f.delete()
-        return {'favorite': marshal(f, favorite_fields), 'action': 'deleted'}
+        remove_favorite(f)
+        return {'favorite': marshal_favorite(f), 'action': 'deleted'}
 
 
 class FavoritesUserApi(Resource):
@@ -90,25 +124,19 @@ class FavoritesUserApi(Resource):
 
     @requires_auth
     def get(self, id):
-        favorites = []
-        u = User.get_by_id(id)
+        u = entity_cache.get_by_id(User, id)
         if u is None:
             abort(404, message="User not found")
-        for f in generate_sorted_query(Favorites).filter('user', u):
-            favorites.append(f)
-        return {'favorites': map(lambda f: marshal(f, favorite_user_fields), favorites)}
+        return list_response('favorites', Favorites, marshal_favorite_user, [Favorites.beer, Favorites.user], user=u)
 
 
 class FavoritesBeerApi(Resource):
     @requires_auth
     def get(self, id):
-        favorites = []
-        b = Beer.get_by_id(id)
+        b = entity_cache.get_by_id(Beer, id)
         if b is None:
             abort(404, message="Beer not found")
-        for f in generate_sorted_query(Favorites).filter('beer', b):
-            favorites.append(f)
-        return {'favorites': map(lambda f: marshal(f, favorite_beer_fields), favorites)}
+        return list_response('favorites', Favorites, marshal_favorite_beer, [Favorites.beer, Favorites.user], beer=b)
 
     @requires_auth
     def post(self, id):
@@ -119,11 +147,11 @@ class FavoritesBeerApi(Resource):
         u = get_user()
         if u is None:
             abort(404, message="User not found.")
-        f = Favorites.all().filter('user', u).filter('beer', Key.from_path('Beer', id)).get()
+        f = Favorites.get(favorite_key(u.key(), id)) or legacy_favorite(u, db.Key.from_path('Beer', id))
         if f is None:
             abort(404, message="Favorite not found")
-        f.delete()
-        return {'favorite': marshal(f, favorite_fields), 'action': 'deleted'}
+        remove_favorite(f)
+        return {'favorite': marshal_favorite(f), 'action': 'deleted'}
 
 
 def add_favorite(beer_id):
@@ -131,17 +159,67 @@ def add_favorite(beer_id):
     if u is None:
         abort(404, message="User not found")
 
-    b = Beer.get_by_id(beer_id)
+    b = entity_cache.get_by_id(Beer, beer_id)
     if b is None:
         abort(404, message="Beer not found")
-    f = Favorites.all(keys_only=True) \
-        .filter('user', u)\
-        .filter('beer', b) \
-        .get()
-    if f:
+    if legacy_favorite(u, b.key()) is not None:
         abort(409, message="User already has this beer marked as favorite")
 
-    f = Favorites(user=u,
-                  beer=b)
-    f.put()
-    return {'favorite': marshal(f, favorite_fields)}
+    def txn():
+        key = favorite_key(u.key(), beer_id)
+        if Favorites.get(key) is not None:
+            return None
+        favorite = Favorites(key=key,
+                             user=u,
+                             beer=b)
+        favorite.put()
+        update_stats(u.key(), favorites=1)
+        return favorite
+
+    f = db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+    if f is None:
+        abort(409, message="User already has this beer marked as favorite")
+    return {'favorite': marshal_favorite(f)}
+
+
+def remove_favorite(f):
+    """Deletes the favorite and takes it off the user's stats, a favorite deleted concurrently is counted once"""
+    def txn():
+        if db.get(f.key()) is None:
+            return
+        db.delete(f.key())
+        update_stats(Favorites.user.get_value_for_datastore(f), favorites=-1)
+
+    db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+    entity_cache.invalidate(f)
+
+
+def lookup_favorites(beer_ids):
+    try:
+        beer_ids = [int(i) for i in beer_ids.split(',') if i.strip()]
+    except ValueError:
+        abort(400, message="beer_ids must be a comma separated list of beer ids")
+    if len(beer_ids) > MAX_LOOKUP_IDS:
+        abort(400, message="At most %d beer_ids can be looked up at once" % MAX_LOOKUP_IDS)
+    user_key = get_user_key()
+    favorites = db.get([favorite_key(user_key, beer_id) for beer_id in beer_ids])
+    return {'favorited': [{'beer_id': beer_id, 'favorited': f is not None} for beer_id, f in zip(beer_ids, favorites)]}
+
+
+@admin_job('favorite_keys')
+def migrate_favorite_keys(cursor):
+    query = Favorites.all()
+    if cursor:
+        query.with_cursor(cursor)
+    favorites = query.fetch(JOB_BATCH_SIZE)
+    legacy = [f for f in favorites if f.key().name() is None]
+    keyed = [Favorites(key=favorite_key(Favorites.user.get_value_for_datastore(f),
+                                        Favorites.beer.get_value_for_datastore(f).id()),
+                       user=Favorites.user.get_value_for_datastore(f),
+                       beer=Favorites.beer.get_value_for_datastore(f))
+             for f in legacy]
+    db.put(keyed)
+    db.delete(legacy)
+    if legacy:
+        entity_cache.invalidate(*legacy)
+    return len(favorites), query.cursor() if len(favorites) == JOB_BATCH_SIZE else None
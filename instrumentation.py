@@ -0,0 +1,213 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from flask import request
+from google.appengine.api import apiproxy_stub_map
+from werkzeug.wsgi import ClosingIterator
+
+__author__ = 'wojtowpj'
+
+# histogram bucket upper bounds in milliseconds, the last bucket holds everything slower
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+WINDOW_SECONDS = 300
+TIMERS = ('datastore', 'auth', 'marshal')
+
+_local = threading.local()
+_lock = threading.Lock()
+# (window number, {endpoint: EndpointStats}) for the current and the previous window
+_windows = deque(maxlen=2)
+
+
+class Histogram(object):
+    """Request latencies counted into fixed buckets, percentiles are reported as bucket upper bounds"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        rank = p * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max
+        return 0.0
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count,
+                'mean_ms': round(self.total / self.count, 2),
+                'p50_ms': self.percentile(0.5),
+                'p95_ms': self.percentile(0.95),
+                'p99_ms': self.percentile(0.99),
+                'max_ms': round(self.max, 2)}
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.wall = Histogram()
+        self.timers = dict((t, Histogram()) for t in TIMERS)
+        self.datastore_calls = 0
+        self.errors = 0
+
+    def merge(self, other):
+        self.wall.merge(other.wall)
+        for t in TIMERS:
+            self.timers[t].merge(other.timers[t])
+        self.datastore_calls += other.datastore_calls
+        self.errors += other.errors
+
+    def summary(self):
+        summary = {'wall': self.wall.summary(),
+                   'errors': self.errors,
+                   'datastore_calls_per_request': round(float(self.datastore_calls) / (self.wall.count or 1), 2)}
+        for t in TIMERS:
+            summary[t] = self.timers[t].summary()
+        return summary
+
+
+class RequestStats(object):
+    """What one request spent its time on, kept in a thread local while the request runs"""
+
+    def __init__(self, path):
+        self.start = time.time()
+        self.path = path
+        self.endpoint = None
+        self.datastore_calls = 0
+        self.timers = dict((t, 0.0) for t in TIMERS)
+        self.pending = {}
+
+
+def current():
+    return getattr(_local, 'stats', None)
+
+
+class timed(object):
+    """Adds the time spent in the with block to the current request's timer"""
+
+    def __init__(self, timer):
+        self.timer = timer
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        stats = current()
+        if stats is not None:
+            stats.timers[self.timer] += (time.time() - self.start) * 1000
+
+
+def _pre_call(service, call, rpc_request, rpc_response):
+    stats = current()
+    if stats is not None:
+        stats.pending[id(rpc_request)] = time.time()
+
+
+def _post_call(service, call, rpc_request, rpc_response, rpc=None, error=None):
+    stats = current()
+    if stats is None:
+        return
+    start = stats.pending.pop(id(rpc_request), None)
+    stats.datastore_calls += 1
+    if start is not None:
+        stats.timers['datastore'] += (time.time() - start) * 1000
+
+
+def _record(stats, status):
+    wall_ms = (time.time() - stats.start) * 1000
+    endpoint = stats.endpoint or 'unmatched'
+    window = int(stats.start / WINDOW_SECONDS)
+    with _lock:
+        if not _windows or _windows[-1][0] != window:
+            _windows.append((window, {}))
+        endpoints = _windows[-1][1]
+        endpoint_stats = endpoints.get(endpoint)
+        if endpoint_stats is None:
+            endpoint_stats = endpoints[endpoint] = EndpointStats()
+        endpoint_stats.wall.add(wall_ms)
+        for t in TIMERS:
+            endpoint_stats.timers[t].add(stats.timers[t])
+        endpoint_stats.datastore_calls += stats.datastore_calls
+        if status.startswith('5'):
+            endpoint_stats.errors += 1
+    logging.info('request_stats %s', json.dumps({'endpoint': endpoint,
+                                                 'path': stats.path,
+                                                 'status': status.split(' ', 1)[0],
+                                                 'wall_ms': round(wall_ms, 2),
+                                                 'datastore_calls': stats.datastore_calls,
+                                                 'datastore_ms': round(stats.timers['datastore'], 2),
+                                                 'auth_ms': round(stats.timers['auth'], 2),
+                                                 'marshal_ms': round(stats.timers['marshal'], 2)}))
+
+
+def snapshot():
+    """Latency summaries per endpoint over the last one to two WINDOW_SECONDS"""
+    window = int(time.time() / WINDOW_SECONDS)
+    merged = {}
+    with _lock:
+        for number, endpoints in _windows:
+            if number < window - 1:
+                continue
+            for endpoint, endpoint_stats in endpoints.items():
+                merged.setdefault(endpoint, EndpointStats()).merge(endpoint_stats)
+    return dict((endpoint, s.summary()) for endpoint, s in merged.items())
+
+
+class InstrumentationMiddleware(object):
+    """Times each request including its streamed body, then records it under the endpoint flask matched"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        stats = _local.stats = RequestStats(environ.get('PATH_INFO'))
+        status = ['500 INTERNAL SERVER ERROR']
+
+        def instrumented_start_response(response_status, headers, exc_info=None):
+            status[0] = response_status
+            return start_response(response_status, headers, exc_info)
+
+        def finish():
+            _local.stats = None
+            _record(stats, status[0])
+
+        try:
+            body = self.wsgi_app(environ, instrumented_start_response)
+        except Exception:
+            finish()
+            raise
+        return ClosingIterator(body, finish)
+
+
+def _name_endpoint():
+    stats = current()
+    if stats is not None:
+        stats.endpoint = request.endpoint
+
+
+def init_app(app):
+    """Wraps the app with the middleware and hooks datastore calls, the hooks are installed once per process"""
+    app.wsgi_app = InstrumentationMiddleware(app.wsgi_app)
+    app.before_request(_name_endpoint)
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('instrumentation', _pre_call, 'datastore_v3')
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('instrumentation', _post_call, 'datastore_v3')
@@ -0,0 +1,214 @@
+import bisect
+import json
+
+from flask.ext.restful import Resource, fields, reqparse, abort
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+from admin_api import admin_job, JOB_BATCH_SIZE
+from auth import requires_auth, requires_task_queue
+from db_helper import IdUrlField
+import entity_cache
+from review_summary import BeerReviewSummary, PendingLeaderboardUpdate, get_summaries, merge_summaries, \
+    summary_values
+from serializer import compile_fields
+from versioning import conditional, bump_version
+
+__author__ = 'wojtowpj'
+
+LEADERBOARD_DIMENSIONS = ('aroma', 'appearance', 'taste', 'palate', 'bottle_style', 'overall')
+LEADERBOARD_SIZE = 1000
+LEADERBOARD_CACHE_PREFIX = 'leaderboard:'
+LEADERBOARD_CACHE_TIME = 3600
+DEFAULT_TOP = 10
+MAX_TOP = 100
+QUERY_BATCH_SIZE = 100
+# filtered requests read at most this many summaries per beer asked for, so a min_count few beers reach
+# ranks the best of the summaries read instead of scanning the catalogue
+QUERY_SCAN_FACTOR = 10
+UPDATE_TASK_URL = '/_tasks/leaderboards/update'
+UPDATE_BATCH_SIZE = 500
+# bounds one run of the update task, whatever is left is placed by the next run
+MAX_UPDATE_BATCHES = 20
+
+
+class BeerLeaderboard(db.Model):
+    """The top LEADERBOARD_SIZE beers for one score dimension, key_name is the dimension
+
+    entries is a JSON list of [beer id, score, review count], best score first. Boards written before
+    styles moved to BeerReviewSummary have the style as a fourth element, it is ignored.
+    """
+    entries = db.TextProperty(default='[]')
+
+
+def leaderboard_keys():
+    return [db.Key.from_path('BeerLeaderboard', d) for d in LEADERBOARD_DIMENSIONS]
+
+
+def _place(entries, beer_id, score, count):
+    entries[:] = [e for e in entries if e[0] != beer_id]
+    if score is None:
+        return
+    # entries are sorted by descending score, bisect over the negated scores
+    i = bisect.bisect_right([-e[1] for e in entries], -score)
+    if i < LEADERBOARD_SIZE:
+        entries.insert(i, [beer_id, score, count])
+        del entries[LEADERBOARD_SIZE:]
+
+
+def update_leaderboards(summaries):
+    """Places each beer in summaries (beer key -> summary values, None once it has no reviews) on the leaderboards"""
+    if not summaries:
+        return
+
+    def txn():
+        boards = db.get(leaderboard_keys())
+        for i, dimension in enumerate(LEADERBOARD_DIMENSIONS):
+            board = boards[i] or BeerLeaderboard(key_name=dimension)
+            entries = json.loads(board.entries)
+            for beer_key, values in summaries.items():
+                if values:
+                    _place(entries, beer_key.id(), values[dimension], values['count'])
+                else:
+                    _place(entries, beer_key.id(), None, 0)
+            board.entries = json.dumps(entries)
+            boards[i] = board
+        db.put(boards)
+        return boards
+
+    boards = db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+    memcache.set_multi(dict((b.key().name(), b.entries) for b in boards), time=LEADERBOARD_CACHE_TIME,
+                       key_prefix=LEADERBOARD_CACHE_PREFIX)
+    bump_version('BeerLeaderboard')
+
+
+def apply_pending_updates():
+    """Places the beers marked by refresh_summary on the leaderboards, with one board transaction per batch"""
+    placed = 0
+    for _ in range(MAX_UPDATE_BATCHES):
+        marker_keys = PendingLeaderboardUpdate.all(keys_only=True).fetch(UPDATE_BATCH_SIZE)
+        if not marker_keys:
+            break
+        # markers are dropped before the summaries are read, a beer refreshed meanwhile is marked again
+        db.delete(marker_keys)
+        beer_keys = [db.Key.from_path('Beer', int(k.name())) for k in marker_keys]
+        try:
+            summaries = get_summaries(beer_keys)
+            update_leaderboards(dict((k, summary_values(s) if s is not None else None)
+                                     for k, s in zip(beer_keys, summaries)))
+        except Exception:
+            db.put([PendingLeaderboardUpdate(key=k) for k in marker_keys])
+            raise
+        placed += len(marker_keys)
+        if len(marker_keys) < UPDATE_BATCH_SIZE:
+            break
+    return placed
+
+
+class LeaderboardUpdateTaskApi(Resource):
+    @requires_task_queue
+    def get(self):
+        return {'placed': apply_pending_updates()}
+
+
+def clear_leaderboards():
+    db.delete(leaderboard_keys())
+    memcache.delete_multi(LEADERBOARD_DIMENSIONS, key_prefix=LEADERBOARD_CACHE_PREFIX)
+    bump_version('BeerLeaderboard')
+
+
+def get_entries(dimension):
+    data = memcache.get(LEADERBOARD_CACHE_PREFIX + dimension)
+    if data is None:
+        board = BeerLeaderboard.get_by_key_name(dimension)
+        data = board.entries if board is not None else '[]'
+        memcache.add(LEADERBOARD_CACHE_PREFIX + dimension, data, time=LEADERBOARD_CACHE_TIME)
+    return json.loads(data)
+
+
+def query_top(dimension, style, min_count, limit):
+    """The best beers by dimension read through the BeerReviewSummary indexes, for filters the boards cannot answer
+
+    Summaries with fewer than min_count reviews are skipped while reading, at most limit * QUERY_SCAN_FACTOR
+    summaries are read, so fewer than limit beers can be returned.
+    """
+    query = BeerReviewSummary.all().order('-' + dimension)
+    if style is not None:
+        query.filter('style', style)
+    top, seen = [], set()
+    for s in query.run(batch_size=QUERY_BATCH_SIZE, limit=limit * QUERY_SCAN_FACTOR):
+        beer_id = BeerReviewSummary.beer.get_value_for_datastore(s).id()
+        if (s.count or 0) < min_count or beer_id in seen:
+            continue
+        seen.add(beer_id)
+        top.append((beer_id, getattr(s, dimension), s.count))
+        if len(top) == limit:
+            break
+    return top
+
+
+@admin_job('leaderboards')
+def rebuild_leaderboards(cursor):
+    query = BeerReviewSummary.all()
+    if cursor:
+        query.with_cursor(cursor)
+    else:
+        clear_leaderboards()
+    stored = query.fetch(JOB_BATCH_SIZE)
+    # summaries written before they carried the beer's style get it here
+    beers = entity_cache.get([BeerReviewSummary.beer.get_value_for_datastore(s) for s in stored])
+    for s, beer in zip(stored, beers):
+        s.style = beer.style if beer is not None else None
+    db.put(stored)
+    summaries = merge_summaries(stored)
+    update_leaderboards(dict((BeerReviewSummary.beer.get_value_for_datastore(s), summary_values(s))
+                             for s in summaries))
+    return len(stored), query.cursor() if len(stored) == JOB_BATCH_SIZE else None
+
+
+leaderboard_beer_fields = {
+    'name': fields.String,
+    'style': fields.String,
+    'uri': IdUrlField('beer', absolute=True),
+}
+
+leaderboard_fields = {
+    'rank': fields.Integer,
+    'score': fields.Float,
+    'count': fields.Integer,
+    'beer': fields.Nested(leaderboard_beer_fields),
+}
+marshal_leaderboard = compile_fields(leaderboard_fields)
+
+
+class LeaderboardApi(Resource):
+    def __init__(self):
+        self.getparse = reqparse.RequestParser()
+        self.getparse.add_argument('sort', type=str, default='overall', location='args')
+        self.getparse.add_argument('style', type=str, location='args')
+        self.getparse.add_argument('min_count', type=int, default=1, location='args')
+        self.getparse.add_argument('limit', type=int, default=DEFAULT_TOP, location='args')
+
+        super(LeaderboardApi, self).__init__()
+
+    @requires_auth
+    @conditional('BeerLeaderboard', 'Beer')
+    def get(self):
+        args = self.getparse.parse_args()
+        if args.sort not in LEADERBOARD_DIMENSIONS:
+            abort(400, message="sort must be one of %s" % ', '.join(LEADERBOARD_DIMENSIONS))
+        if not 0 < args.limit <= MAX_TOP:
+            abort(400, message="limit must be between 1 and %d" % MAX_TOP)
+
+        if args.style is None and args.min_count <= 1:
+            top = [tuple(entry[:3]) for entry in get_entries(args.sort)[:args.limit]]
+        else:
+            top = query_top(args.sort, args.style, args.min_count, args.limit)
+
+        beers = entity_cache.get([db.Key.from_path('Beer', beer_id) for beer_id, score, count in top])
+        # beers deleted since they were ranked are skipped
+        ranked = [{'score': score, 'count': count, 'beer': beer}
+                  for (beer_id, score, count), beer in zip(top, beers) if beer is not None]
+        for rank, entry in enumerate(ranked, 1):
+            entry['rank'] = rank
+        return {'leaderboard': marshal_leaderboard(ranked), 'sort': args.sort}
@@ -0,0 +1,208 @@
+import logging
+from collections import defaultdict
+
+from flask.ext.restful import Resource, fields, reqparse, abort
+from google.appengine.ext import db
+
+from auth import requires_auth, requires_task_queue
+from beer_review_api import BeerReview
+from db_helper import IdUrlField
+import entity_cache
+from favorites_api import Favorites
+from serializer import compile_fields
+from user_api import User
+
+__author__ = 'wojtowpj'
+
+REBUILD_TASK_URL = '/_tasks/recommendations/rebuild'
+REBUILD_BATCH_SIZE = 1000
+PUT_BATCH_SIZE = 500
+NEIGHBORS = 20
+# beers are scored against all beers a block at a time. A block's similarities are at most BLOCK_CELLS floats
+# (16MB) and the co-occurrences counted into them at most BLOCK_PAIRS, held in about five arrays of 8 byte values
+# (20MB) while the block is built. A beer whose likers alone like more than BLOCK_PAIRS beers gets its own block.
+BLOCK_CELLS = 2 * 1024 * 1024
+BLOCK_PAIRS = 512 * 1024
+MAX_SEEDS = 100
+DEFAULT_RECOMMENDATIONS = 10
+MAX_RECOMMENDATIONS = 50
+
+
+class BeerNeighbors(db.Model):
+    """The beers most similar to a beer by who liked them, the id is the beer's id"""
+    neighbors = db.ListProperty(int, indexed=False)
+    scores = db.ListProperty(float, indexed=False)
+
+
+def _stream(query):
+    """Runs query to the end one batch at a time, continuing each batch from the previous batch's cursor"""
+    while True:
+        batch = query.fetch(REBUILD_BATCH_SIZE)
+        for entity in batch:
+            yield entity
+        if len(batch) < REBUILD_BATCH_SIZE:
+            return
+        query.with_cursor(query.cursor())
+
+
+def liked_pairs():
+    """Returns the (user id, beer id) pairs of every favorite and of every review scored at or above the user's mean"""
+    import numpy
+
+    users, beers = [], []
+    for f in _stream(Favorites.all()):
+        users.append(Favorites.user.get_value_for_datastore(f).id())
+        beers.append(Favorites.beer.get_value_for_datastore(f).id())
+
+    review_users, review_beers, review_scores = [], [], []
+    for r in _stream(BeerReview.all()):
+        review_users.append(BeerReview.user.get_value_for_datastore(r).id())
+        review_beers.append(BeerReview.beer.get_value_for_datastore(r).id())
+        review_scores.append(r.overall)
+    if review_users:
+        # scores are only compared with the user's own mean, so every user's scale is treated the same
+        reviewers, reviewer_index = numpy.unique(numpy.array(review_users), return_inverse=True)
+        scores = numpy.array(review_scores)
+        means = numpy.bincount(reviewer_index, weights=scores) / numpy.bincount(reviewer_index)
+        liked = scores >= means[reviewer_index]
+        users.extend(numpy.array(review_users)[liked].tolist())
+        beers.extend(numpy.array(review_beers)[liked].tolist())
+    return numpy.array(users, dtype=numpy.int64), numpy.array(beers, dtype=numpy.int64)
+
+
+def compute_neighbors(user_ids, beer_ids, k=NEIGHBORS):
+    """Top k item-item cosine similarities from liked (user id, beer id) pairs, returns beer id -> (ids, scores)"""
+    import numpy
+
+    user_index = numpy.unique(user_ids, return_inverse=True)[1]
+    beers, beer_index = numpy.unique(beer_ids, return_inverse=True)
+    # a beer both favorited and liked in a review counts once
+    pairs = numpy.unique(user_index.astype(numpy.int64) * len(beers) + beer_index)
+    user_index, beer_index = pairs // len(beers), pairs % len(beers)
+    # users with a single liked beer add nothing to any similarity
+    keep = numpy.bincount(user_index)[user_index] > 1
+    if not keep.any():
+        return {}
+    user_index = numpy.unique(user_index[keep], return_inverse=True)[1]
+    beer_columns, beer_index = numpy.unique(beer_index[keep], return_inverse=True)
+    beers = beers[beer_columns]
+
+    # the pairs are sorted by user, so each user's liked beers are a contiguous run starting at starts[user]
+    degree = numpy.bincount(user_index)
+    starts = numpy.cumsum(degree) - degree
+    likes = numpy.bincount(beer_index, minlength=len(beers))
+    norms = numpy.sqrt(likes)
+    inverse_norms = 1.0 / norms
+    # the pairs of each beer in beer order, beer b's run starts at offsets[b]
+    by_beer = numpy.argsort(beer_index, kind='mergesort')
+    offsets = numpy.concatenate(([0], numpy.cumsum(likes)))
+    # co-occurrences counted for each beer, its likers' liked beers
+    expansion = numpy.cumsum(numpy.bincount(beer_index, weights=degree[user_index], minlength=len(beers)))
+
+    neighbors = {}
+    start = 0
+    while start < len(beers):
+        end = numpy.searchsorted(expansion, (expansion[start - 1] if start else 0) + BLOCK_PAIRS, side='right')
+        end = int(min(max(end, start + 1), start + max(1, BLOCK_CELLS // len(beers)), len(beers)))
+        # similarities of the block's beers with every beer, summed over the liked beers of each of their users
+        pairs = by_beer[offsets[start]:offsets[end]]
+        widths = degree[user_index[pairs]]
+        liked = numpy.repeat(starts[user_index[pairs]] - (numpy.cumsum(widths) - widths), widths)
+        liked += numpy.arange(widths.sum())
+        columns = beer_index[liked]
+        del liked
+        cells = numpy.repeat(beer_index[pairs] - start, widths)
+        cells *= len(beers)
+        cells += columns
+        weights = inverse_norms[columns]
+        del columns
+        similarity = numpy.bincount(cells, weights=weights, minlength=(end - start) * len(beers))
+        del cells, weights
+        similarity = similarity.reshape(end - start, len(beers))
+        similarity /= norms[start:end, numpy.newaxis]
+        for row in range(end - start):
+            scores = similarity[row]
+            scores[start + row] = 0.0
+            columns = numpy.argsort(scores)[-k:][::-1]
+            columns = columns[scores[columns] > 0]
+            neighbors[int(beers[start + row])] = (beers[columns].tolist(), scores[columns].tolist())
+        del similarity
+        start = end
+    return neighbors
+
+
+def rebuild_neighbors():
+    user_ids, beer_ids = liked_pairs()
+    neighbors = compute_neighbors(user_ids, beer_ids)
+    entities = [BeerNeighbors(key=db.Key.from_path('BeerNeighbors', beer_id), neighbors=ids, scores=scores)
+                for beer_id, (ids, scores) in neighbors.items()]
+    for i in range(0, len(entities), PUT_BATCH_SIZE):
+        db.put(entities[i:i + PUT_BATCH_SIZE])
+    stale = [k for k in _stream(BeerNeighbors.all(keys_only=True)) if k.id() not in neighbors]
+    for i in range(0, len(stale), PUT_BATCH_SIZE):
+        db.delete(stale[i:i + PUT_BATCH_SIZE])
+    logging.info('Rebuilt neighbours of %d beers from %d liked pairs, deleted %d', len(entities), len(user_ids),
+                 len(stale))
+    return len(entities)
+
+
+class RecommendationsRebuildTaskApi(Resource):
+    @requires_task_queue
+    def get(self):
+        return {'beers': rebuild_neighbors()}
+
+
+recommended_beer_fields = {
+    'name': fields.String,
+    'style': fields.String,
+    'uri': IdUrlField('beer', absolute=True),
+}
+
+recommendation_fields = {
+    'score': fields.Float,
+    'beer': fields.Nested(recommended_beer_fields),
+}
+marshal_recommendation = compile_fields(recommendation_fields)
+
+
+class RecommendationsApi(Resource):
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('limit', type=int, default=DEFAULT_RECOMMENDATIONS, location='args')
+
+        super(RecommendationsApi, self).__init__()
+
+    @requires_auth
+    def get(self, id):
+        args = self.reqparse.parse_args()
+        if not 0 < args.limit <= MAX_RECOMMENDATIONS:
+            abort(400, message="limit must be between 1 and %d" % MAX_RECOMMENDATIONS)
+        u = entity_cache.get_by_id(User, id)
+        if u is None:
+            abort(404, message="User not found")
+
+        favorites = Favorites.all().filter('user', u).fetch(MAX_SEEDS)
+        reviews = BeerReview.all().filter('user', u).order('-date_created').fetch(MAX_SEEDS)
+        seen = set(Favorites.beer.get_value_for_datastore(f) for f in favorites)
+        seeds = set(seen)
+        if reviews:
+            mean = sum(r.overall for r in reviews) / len(reviews)
+            for r in reviews:
+                beer_key = BeerReview.beer.get_value_for_datastore(r)
+                seen.add(beer_key)
+                if r.overall >= mean:
+                    seeds.add(beer_key)
+
+        scores = defaultdict(float)
+        for n in db.get([db.Key.from_path('BeerNeighbors', k.id()) for k in seeds]):
+            if n is None:
+                continue
+            for beer_id, score in zip(n.neighbors, n.scores):
+                scores[beer_id] += score
+        ranked = sorted((beer_id for beer_id in scores if db.Key.from_path('Beer', beer_id) not in seen),
+                        key=lambda beer_id: -scores[beer_id])[:args.limit]
+
+        beers = entity_cache.get([db.Key.from_path('Beer', beer_id) for beer_id in ranked])
+        recommendations = [{'score': scores[beer_id], 'beer': beer}
+                           for beer_id, beer in zip(ranked, beers) if beer is not None]
+        return {'recommendations': marshal_recommendation(recommendations)}
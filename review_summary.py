@@ -0,0 +1,259 @@
+import logging
+import random
+import time
+
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import db
+
+from admin_api import admin_job, JOB_BATCH_SIZE
+from beer_api import Beer
+import entity_cache
+
+__author__ = 'wojtowpj'
+
+SUMMARY_SHARDS = 10
+SCORE_FIELDS = ('aroma', 'appearance', 'taste', 'palate', 'bottle_style', 'overall')
+SUMMARY_CACHE_PREFIX = 'review_summary:'
+SUMMARY_CACHE_TIME = 600
+FOLD_TASK_URL = '/_tasks/review_summary/fold'
+FOLD_QUEUE = 'review-summary'
+FOLD_DELAY = 5
+FOLD_BATCH_SIZE = 200
+SWEEP_TASK_URL = '/_tasks/review_summary/sweep'
+# pending reviews read by one sweep, the beers they belong to get a fold
+SWEEP_BATCH_SIZE = 1000
+
+
+class BeerReviewSummary(db.Model):
+    """Merged summary of a beer's reviews, key_name is the beer id
+
+    The shards are authoritative. This entity is refreshed from them after writes so summaries
+    can be listed and sorted, summaries created before sharding have an id instead of a key_name.
+    style is copied from the beer so leaderboards can be filtered by style.
+    """
+    beer = db.ReferenceProperty(Beer, required=True)
+    style = db.StringProperty()
+    count = db.IntegerProperty()
+    aroma = db.FloatProperty(required=True)
+    appearance = db.FloatProperty(required=True)
+    taste = db.FloatProperty(required=True)
+    palate = db.FloatProperty(required=True)
+    bottle_style = db.FloatProperty(required=True)
+    overall = db.FloatProperty(required=True)
+
+
+class BeerReviewSummaryShard(db.Model):
+    """Review count and score sums for one shard of a beer's summary, key_name is '<beer id>:<shard>'"""
+    beer = db.ReferenceProperty(Beer, required=True)
+    count = db.IntegerProperty(default=0)
+    aroma = db.FloatProperty(default=0.0)
+    appearance = db.FloatProperty(default=0.0)
+    taste = db.FloatProperty(default=0.0)
+    palate = db.FloatProperty(default=0.0)
+    bottle_style = db.FloatProperty(default=0.0)
+    overall = db.FloatProperty(default=0.0)
+
+
+class PendingReviewScores(db.Model):
+    """Scores of a review not yet folded into its summary, the parent is the summary shard it is folded into"""
+    aroma = db.FloatProperty(required=True)
+    appearance = db.FloatProperty(required=True)
+    taste = db.FloatProperty(required=True)
+    palate = db.FloatProperty(required=True)
+    bottle_style = db.FloatProperty(required=True)
+    overall = db.FloatProperty(required=True)
+
+
+class PendingLeaderboardUpdate(db.Model):
+    """A beer whose summary changed since it was last placed on the leaderboards, key_name is the beer id"""
+
+
+def shard_keys(beer_key):
+    return [db.Key.from_path('BeerReviewSummaryShard', '%d:%d' % (beer_key.id(), i)) for i in range(SUMMARY_SHARDS)]
+
+
+def score_sums(reviews):
+    return dict((f, sum(getattr(r, f) for r in reviews)) for f in SCORE_FIELDS)
+
+
+def pending_scores(beer_key, review):
+    """Returns the PendingReviewScores for a new review, to be put in the same transaction as the review"""
+    return PendingReviewScores(parent=random.choice(shard_keys(beer_key)),
+                               **dict((f, getattr(review, f)) for f in SCORE_FIELDS))
+
+
+def schedule_fold(beer_key):
+    """Queues a fold of the beer's pending reviews, reviews arriving within FOLD_DELAY share one task"""
+    window = int(time.time() / FOLD_DELAY) + 1
+    for w in (window, window + 1):
+        try:
+            taskqueue.add(name='fold-%d-%d' % (beer_key.id(), w),
+                          url=FOLD_TASK_URL,
+                          params={'beer_id': beer_key.id()},
+                          countdown=max(0, w * FOLD_DELAY - time.time()),
+                          queue_name=FOLD_QUEUE)
+            return
+        except taskqueue.TaskAlreadyExistsError:
+            return
+        except taskqueue.TombstonedTaskError:
+            # this window's fold already ran, schedule one for the next window
+            continue
+        except taskqueue.Error:
+            # the reviews are saved with their pending scores, sweep_pending_reviews schedules the fold later
+            logging.warning('Could not schedule the review summary fold of beer %d', beer_key.id(), exc_info=True)
+            return
+
+
+def sweep_pending_reviews():
+    """Schedules a fold for the beers with pending reviews, catches up beers whose fold could not be scheduled"""
+    shards = set(k.parent() for k in PendingReviewScores.all(keys_only=True).run(limit=SWEEP_BATCH_SIZE))
+    # shard key names are '<beer id>:<shard>'
+    beer_ids = set(int(k.name().split(':')[0]) for k in shards)
+    for beer_id in beer_ids:
+        schedule_fold(db.Key.from_path('Beer', beer_id))
+    return len(beer_ids)
+
+
+def _fold_shard(beer_key, shard_key):
+    pending = PendingReviewScores.all().ancestor(shard_key).fetch(FOLD_BATCH_SIZE)
+    if not pending:
+        return 0
+    shard = db.get(shard_key) or BeerReviewSummaryShard(key=shard_key, beer=beer_key)
+    shard.count += len(pending)
+    sums = score_sums(pending)
+    for f in SCORE_FIELDS:
+        setattr(shard, f, getattr(shard, f) + sums[f])
+    shard.put()
+    db.delete(pending)
+    return len(pending)
+
+
+def fold_pending_reviews(beer_key):
+    """Folds every pending review of the beer into its shards, safe to run more than once"""
+    folded = 0
+    for shard_key in shard_keys(beer_key):
+        while True:
+            count = db.run_in_transaction(_fold_shard, beer_key, shard_key)
+            folded += count
+            if count < FOLD_BATCH_SIZE:
+                break
+    # refresh even when nothing was pending so a retried task still catches the summary up
+    refresh_summary(beer_key)
+    return folded
+
+
+def _merge_shards(shards):
+    shards = [s for s in shards if s is not None and s.count]
+    count = sum(s.count for s in shards)
+    if not count:
+        return None
+    values = dict((f, sum(getattr(s, f) for s in shards) / count) for f in SCORE_FIELDS)
+    values['count'] = count
+    return values
+
+
+def summary_values(summary):
+    values = dict((f, getattr(summary, f)) for f in SCORE_FIELDS)
+    values['count'] = summary.count
+    return values
+
+
+def get_summaries(beer_keys, fallbacks=None):
+    """Returns the merged summary of each beer in beer_keys, None for beers without reviews
+
+    fallbacks maps beer keys to summaries created before sharding, they are used for beers that
+    have no shards yet, other such beers are looked up with a query.
+    """
+    fallbacks = fallbacks or {}
+    cached = memcache.get_multi([str(k.id()) for k in beer_keys], key_prefix=SUMMARY_CACHE_PREFIX)
+    missing = [k for k in beer_keys if str(k.id()) not in cached]
+    if missing:
+        shards = db.get([shard_key for k in missing for shard_key in shard_keys(k)])
+        loaded = {}
+        for i, beer_key in enumerate(missing):
+            values = _merge_shards(shards[i * SUMMARY_SHARDS:(i + 1) * SUMMARY_SHARDS])
+            if values is None:
+                legacy = fallbacks.get(beer_key) or BeerReviewSummary.all().filter('beer', beer_key).get()
+                if legacy is not None:
+                    values = summary_values(legacy)
+            loaded[str(beer_key.id())] = values or {}
+        # add, not set: refresh_summary may have cached newer values since the shards were read
+        memcache.add_multi(loaded, time=SUMMARY_CACHE_TIME, key_prefix=SUMMARY_CACHE_PREFIX)
+        cached.update(loaded)
+
+    summaries = []
+    for beer_key in beer_keys:
+        values = cached[str(beer_key.id())]
+        summaries.append(BeerReviewSummary(beer=beer_key, **values) if values else None)
+    return summaries
+
+
+def get_summary(beer_key):
+    return get_summaries([beer_key])[0]
+
+
+def merge_summaries(summaries):
+    """Replaces the values of queried BeerReviewSummary entities with their merged shards"""
+    beer_keys = [BeerReviewSummary.beer.get_value_for_datastore(s) for s in summaries]
+    merged = get_summaries(beer_keys, fallbacks=dict(zip(beer_keys, summaries)))
+    return [m or s for m, s in zip(merged, summaries)]
+
+
+def _migrate_legacy_summary(legacy):
+    beer_key = BeerReviewSummary.beer.get_value_for_datastore(legacy)
+    shard_key = shard_keys(beer_key)[0]
+
+    def txn():
+        summary = db.get(legacy.key())
+        if summary is None:
+            return
+        shard = db.get(shard_key) or BeerReviewSummaryShard(key=shard_key, beer=beer_key)
+        shard.count += summary.count
+        for f in SCORE_FIELDS:
+            setattr(shard, f, getattr(shard, f) + getattr(summary, f) * summary.count)
+        shard.put()
+        summary.delete()
+
+    db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+
+
+def refresh_summary(beer_key):
+    """Rewrites the beer's BeerReviewSummary from its shards, folding in a pre-sharding summary first
+
+    The beer is only marked for the leaderboards, leaderboard.apply_pending_updates places marked
+    beers in batches so refreshes do not contend on the boards.
+    """
+    key_name = str(beer_key.id())
+    summary = BeerReviewSummary.get_by_key_name(key_name)
+    if summary is None:
+        legacy = BeerReviewSummary.all().filter('beer', beer_key).get()
+        if legacy is not None:
+            _migrate_legacy_summary(legacy)
+            memcache.delete(SUMMARY_CACHE_PREFIX + key_name)
+
+    values = _merge_shards(db.get(shard_keys(beer_key)))
+    memcache.set(SUMMARY_CACHE_PREFIX + key_name, values or {}, time=SUMMARY_CACHE_TIME)
+    PendingLeaderboardUpdate(key_name=key_name).put()
+    if values is None:
+        return None
+    beer = entity_cache.get([beer_key])[0]
+    summary = BeerReviewSummary(key_name=key_name, beer=beer_key, style=beer.style if beer is not None else None,
+                                **values)
+    try:
+        summary.put()
+    except (db.Timeout, db.TransactionFailedError):
+        # the shards are authoritative, the next refresh catches the summary up
+        logging.warning('Could not refresh review summary of beer %s', key_name)
+    return summary
+
+
+@admin_job('review_summary_shards')
+def migrate_review_summaries(cursor):
+    query = BeerReviewSummary.all()
+    if cursor:
+        query.with_cursor(cursor)
+    summaries = query.fetch(JOB_BATCH_SIZE)
+    for summary in summaries:
+        if summary.key().name() is None:
+            refresh_summary(BeerReviewSummary.beer.get_value_for_datastore(summary))
+    return len(summaries), query.cursor() if len(summaries) == JOB_BATCH_SIZE else None
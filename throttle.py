@@ -0,0 +1,73 @@
+import datetime
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+
+__author__ = 'wojtowpj'
+
+MEMCACHE_PREFIX = 'throttle:'
+
+
+class ThrottleMarker(db.Model):
+    """Holds a throttle until expires, the key_name is the throttle name"""
+    expires = db.DateTimeProperty(required=True)
+
+
+def review_throttle(user_key, beer_key):
+    return 'review:%d:%d' % (user_key.id(), beer_key.id())
+
+
+def beer_add_throttle(user_key):
+    return 'beer_add:%d' % user_key.id()
+
+
+def remember(name, expires, now):
+    seconds = int((expires - now).total_seconds())
+    if seconds > 0:
+        memcache.set(MEMCACHE_PREFIX + name, expires, time=seconds)
+
+
+def held_until(names):
+    """Returns {name: expires} for the names that are currently held, read with one batch get"""
+    now = datetime.datetime.utcnow()
+    markers = ThrottleMarker.get_by_key_name(list(names))
+    return dict((m.key().name(), m.expires) for m in markers if m is not None and m.expires > now)
+
+
+def remembered(name):
+    """Returns the seconds until the named throttle is released when memcache knows it is held, otherwise None
+
+    Check it before any datastore reads, so repeats of a held throttle are usually rejected with one memcache get.
+    """
+    now = datetime.datetime.utcnow()
+    expires = memcache.get(MEMCACHE_PREFIX + name)
+    if expires is not None and expires > now:
+        return (expires - now).total_seconds()
+    return None
+
+
+def acquire(name, period, entities, in_transaction=None):
+    """Takes the named throttle for period and puts entities in the same transaction
+
+    in_transaction, when given, is called in the transaction after the put for other writes that have to
+    commit with it. Returns None when the throttle was taken, otherwise the seconds until it is released
+    and nothing is put. Callers check remembered(name) first, acquire always reads the marker in a transaction.
+    """
+    now = datetime.datetime.utcnow()
+
+    def txn():
+        marker = ThrottleMarker.get_by_key_name(name)
+        if marker is not None and marker.expires > now:
+            return marker.expires
+        db.put([ThrottleMarker(key_name=name, expires=now + period)] + list(entities))
+        if in_transaction is not None:
+            in_transaction()
+        return None
+
+    expires = db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+    if expires is None:
+        remember(name, now + period, now)
+        return None
+    remember(name, expires, now)
+    return (expires - now).total_seconds()
@@ -3,10 +3,14 @@ from functools import wraps
 from google.appengine.ext import db
 from google.appengine.api import users
 
-from db_helper import IdUrlField, generate_sorted_query, update_model
+from admin_api import admin_job, JOB_BATCH_SIZE
+import entity_cache
+from serializer import compile_fields
+from db_helper import IdUrlField, update_model, list_response, narrow, requested_ids, ids_response
 from flask import abort, redirect, request
-from flask.ext.restful import Resource, reqparse, fields, marshal
-from auth import requires_auth, hash_password
+from flask.ext.restful import Resource, reqparse, fields
+from auth import requires_auth, hash_password, invalidate_credentials, check_auth, authenticate, get_user, \
+    issue_token, revoke_tokens, tokens_revoked, TOKEN_TTL, index_user_name, user_name_index_key, UserNameIndex
 
 
 def login_required(func):
@@ -25,6 +29,7 @@ class User(db.Model):
     last_name = db.StringProperty(required=True)
     password = db.StringProperty(required=True)
     last_beer_add_date = db.DateTimeProperty(required=False)
+    token_generation = db.IntegerProperty(default=0)
 
     @property
     def id(self):
@@ -38,6 +43,7 @@ user_fields = {
     'last_beer_add_date': fields.DateTime,
     'uri': IdUrlField('user', absolute=True),
 }
+marshal_user = compile_fields(user_fields)
 
 
 class UserListApi(Resource):
@@ -52,24 +58,23 @@ class UserListApi(Resource):
 
     @requires_auth
     def get(self):
-        user_list = []
-        for u in generate_sorted_query(User):
-            user_list.append(u)
-        return {'users': map(lambda u: marshal(u, user_fields), user_list)}
+        ids = requested_ids()
+        if ids is not None:
+            return ids_response('users', User, marshal_user, ids)
+        return list_response('users', User, marshal_user)
 
     @requires_auth
     def post(self):
         args = self.reqparse.parse_args()
 
-        u = User.all(keys_only=True).filter('user_name', args['user_name']).get()
-        if u:
-            abort(409, message="User with user_name '%s' already exists" % args['user_name'])
-        u = User(user_name=args.user_name,
+        u = User(key=db.Key.from_path('User', db.allocate_ids(db.Key.from_path('User', 1), 1)[0]),
+                 user_name=args.user_name,
                  first_name=args.first_name,
                  last_name=args.last_name,
                  password=hash_password(args.password))
-        u.put()
-        return {'user': marshal(u, user_fields)}
+        if not claim_user_name(u, create=True):
+            abort(409, message="User with user_name '%s' already exists" % args['user_name'])
+        return {'user': marshal_user(u)}
 
 
 class UserApi(Resource):
@@ -85,10 +90,10 @@ class UserApi(Resource):
 
     @requires_auth
     def get(self, id):
-        user = User.get_by_id(id)
+        user = entity_cache.get_by_id(User, id)
         if user is None:
             abort(404)
-        return {'user': marshal(user, user_fields)}
+        return {'user': narrow(marshal_user)(user)}
 
     @requires_auth
     def put(self, id):
@@ -99,10 +104,23 @@ class UserApi(Resource):
         u = dict(filter(lambda (k, v): v is not None, args.items()))
         if u.get('password') is not None:
             u['password'] = hash_password(u['password'])
+        old_user_name = user.user_name
         update_model(user, u)
+        renamed = user.user_name != old_user_name
+        if renamed and not claim_user_name(user):
+            abort(409, message="User with user_name '%s' already exists" % user.user_name)
+        if u.get('password') is not None:
+            revoke_tokens(user)
 
         user.put()
-        return {'user': marshal(user, user_fields)}
+        entity_cache.invalidate(user)
+        if u.get('password') is not None:
+            tokens_revoked(user)
+        if renamed:
+            db.delete(user_name_index_key(old_user_name))
+        if u.get('password') is not None or user.user_name != old_user_name:
+            invalidate_credentials(old_user_name)
+        return {'user': marshal_user(user)}
 
     @requires_auth
     def delete(self, id):
@@ -110,5 +128,69 @@ class UserApi(Resource):
         if user is None:
             abort(404)
 
-        user.delete()
-        return {'user': marshal(user, user_fields), 'action': 'deleted'}
+        db.delete([user, user_name_index_key(user.user_name)])
+        entity_cache.invalidate(user)
+        tokens_revoked(user)
+        invalidate_credentials(user.user_name)
+        return {'user': marshal_user(user), 'action': 'deleted'}
+
+
+def claim_user_name(user, create=False):
+    """Indexes user under its user_name unless another user has it, returns whether the name was free
+
+    With create the new user, which needs an allocated id, is put together with its index row, so concurrent
+    creates of one name make one user.
+    """
+    if User.all(keys_only=True).filter('user_name', user.user_name).get() is not None:
+        return False
+
+    def txn():
+        if db.get(user_name_index_key(user.user_name)) is not None:
+            return False
+        db.put([user, index_user_name(user)] if create else index_user_name(user))
+        return True
+
+    return db.run_in_transaction_options(db.create_transaction_options(xg=create), txn)
+
+
+class TokenApi(Resource):
+    def post(self):
+        auth = request.authorization
+        if not auth or not check_auth(auth.username, auth.password):
+            return authenticate()
+        user = get_user()
+        if user is None:
+            return authenticate()
+        return {'token': issue_token(user), 'token_type': 'Bearer', 'expires_in': TOKEN_TTL}
+
+
+def seed_admin():
+    """Creates the initial admin user when there are no users yet, called by the warmup and bootstrap handlers"""
+    if User.all(keys_only=True).get() is not None:
+        return None
+    user_key = db.Key.from_path('User', db.allocate_ids(db.Key.from_path('User', 1), 1)[0])
+    password = hash_password('beer_app1')
+
+    # the user is created together with its name index row, so concurrent warmups create one admin
+    def txn():
+        if UserNameIndex.get_by_key_name('admin') is not None:
+            return None
+        u = User(key=user_key,
+                 user_name='admin',
+                 first_name='Admin',
+                 last_name='Admin',
+                 password=password)
+        db.put([u, index_user_name(u)])
+        return u
+
+    return db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+
+
+@admin_job('user_name_index')
+def migrate_user_name_index(cursor):
+    query = User.all()
+    if cursor:
+        query.with_cursor(cursor)
+    users = query.fetch(JOB_BATCH_SIZE)
+    db.put(map(index_user_name, users))
+    return len(users), query.cursor() if len(users) == JOB_BATCH_SIZE else None
@@ -0,0 +1,125 @@
+import datetime
+
+from flask.ext.restful import fields
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from review_summary import SCORE_FIELDS, score_sums
+from serializer import compile_fields
+
+__author__ = 'wojtowpj'
+
+STATS_TASK_URL = '/_tasks/user_stats/fold'
+FOLD_BATCH_SIZE = 200
+# taskqueue adds at most this many tasks per call
+TASK_BATCH_SIZE = 100
+
+
+class UserStats(db.Model):
+    """Review and favorite counts of a user, key_name is the user id"""
+    review_count = db.IntegerProperty(default=0)
+    aroma_sum = db.FloatProperty(default=0.0)
+    appearance_sum = db.FloatProperty(default=0.0)
+    taste_sum = db.FloatProperty(default=0.0)
+    palate_sum = db.FloatProperty(default=0.0)
+    bottle_style_sum = db.FloatProperty(default=0.0)
+    overall_sum = db.FloatProperty(default=0.0)
+    favorite_count = db.IntegerProperty(default=0)
+    last_activity = db.DateTimeProperty()
+
+    def mean(self, field):
+        if not self.review_count:
+            return None
+        return getattr(self, field + '_sum') / self.review_count
+
+
+class PendingUserStats(db.Model):
+    """Reviews not yet added to a user's stats, the parent is the user's UserStats key"""
+    review_count = db.IntegerProperty(default=0)
+    aroma_sum = db.FloatProperty(default=0.0)
+    appearance_sum = db.FloatProperty(default=0.0)
+    taste_sum = db.FloatProperty(default=0.0)
+    palate_sum = db.FloatProperty(default=0.0)
+    bottle_style_sum = db.FloatProperty(default=0.0)
+    overall_sum = db.FloatProperty(default=0.0)
+
+
+def stats_key(user_key):
+    return db.Key.from_path('UserStats', str(user_key.id()))
+
+
+def update_stats(user_key, reviews=(), favorites=0):
+    """Adds reviews and favorites (negative to remove) to the user's stats, has to run in a transaction
+
+    Callers run it in the transaction that writes the reviews or favorites when they can.
+    """
+    stats = db.get(stats_key(user_key)) or UserStats(key=stats_key(user_key))
+    if reviews:
+        stats.review_count += len(reviews)
+        sums = score_sums(reviews)
+        for f in SCORE_FIELDS:
+            setattr(stats, f + '_sum', getattr(stats, f + '_sum') + sums[f])
+    stats.favorite_count = max(0, stats.favorite_count + favorites)
+    if reviews or favorites > 0:
+        stats.last_activity = datetime.datetime.utcnow()
+    stats.put()
+    return stats
+
+
+def pending_stats(user_key, reviews):
+    """Returns the PendingUserStats for a user's new reviews, to be put with the reviews"""
+    sums = score_sums(reviews)
+    return PendingUserStats(parent=stats_key(user_key), review_count=len(reviews),
+                            **dict((f + '_sum', sums[f]) for f in SCORE_FIELDS))
+
+
+def _fold_stats(user_key):
+    pending = PendingUserStats.all().ancestor(stats_key(user_key)).fetch(FOLD_BATCH_SIZE)
+    if not pending:
+        return 0
+    stats = db.get(stats_key(user_key)) or UserStats(key=stats_key(user_key))
+    for p in pending:
+        stats.review_count += p.review_count
+        for f in SCORE_FIELDS:
+            setattr(stats, f + '_sum', getattr(stats, f + '_sum') + getattr(p, f + '_sum'))
+    stats.last_activity = datetime.datetime.utcnow()
+    stats.put()
+    db.delete(pending)
+    return len(pending)
+
+
+def fold_pending_stats(user_key):
+    """Adds the user's pending reviews to their stats, safe to run more than once"""
+    folded = 0
+    while True:
+        count = db.run_in_transaction(_fold_stats, user_key)
+        folded += count
+        if count < FOLD_BATCH_SIZE:
+            return folded
+
+
+def schedule_stats_folds(user_keys):
+    tasks = [taskqueue.Task(url=STATS_TASK_URL, params={'user_id': k.id()}) for k in user_keys]
+    for i in range(0, len(tasks), TASK_BATCH_SIZE):
+        taskqueue.Queue().add(tasks[i:i + TASK_BATCH_SIZE])
+
+
+def get_stats(user_key):
+    return UserStats.get(stats_key(user_key)) or UserStats(key=stats_key(user_key))
+
+
+user_stats_fields = dict((f, fields.Float) for f in SCORE_FIELDS)
+user_stats_fields.update({
+    'review_count': fields.Integer,
+    'favorite_count': fields.Integer,
+    'last_activity': fields.DateTime,
+})
+_marshal_user_stats = compile_fields(user_stats_fields)
+
+
+def marshal_user_stats(stats):
+    values = dict((f, stats.mean(f)) for f in SCORE_FIELDS)
+    values.update(review_count=stats.review_count,
+                  favorite_count=stats.favorite_count,
+                  last_activity=stats.last_activity)
+    return _marshal_user_stats(values)
@@ -0,0 +1,78 @@
+import hashlib
+import time
+from functools import wraps
+
+from flask import request, Response
+from google.appengine.api import memcache
+
+import entity_cache
+
+__author__ = 'wojtowpj'
+
+VERSION_PREFIX = 'kind_version:'
+RESPONSE_CACHE_PREFIX = 'etag_response:'
+RESPONSE_CACHE_TIME = 600
+BUMPED_PREFIX = 'kind_bumped:'
+# eventually consistent queries can miss a write for a while after it, responses built in this window
+# would carry the new version with the old data, so they are sent untagged and are not cached
+BUMP_SETTLE_SECONDS = 10
+
+
+def _initial_version():
+    # a version counter lost to memcache eviction restarts above any value it handed out before
+    return int(time.time() * 1000)
+
+
+def bump_version(*kinds):
+    """Marks every cached response built from these kinds as stale, call after each create, update and delete"""
+    for kind in kinds:
+        memcache.incr(VERSION_PREFIX + kind, initial_value=_initial_version())
+    memcache.set_multi(dict((kind, True) for kind in kinds), key_prefix=BUMPED_PREFIX, time=BUMP_SETTLE_SECONDS)
+
+
+def get_versions(kinds):
+    """Returns the current version of each kind, None when memcache cannot supply them or one was just bumped"""
+    cached = memcache.get_multi([VERSION_PREFIX + k for k in kinds] + [BUMPED_PREFIX + k for k in kinds])
+    if any(BUMPED_PREFIX + k in cached for k in kinds):
+        return None
+    versions = dict((k, cached[VERSION_PREFIX + k]) for k in kinds if VERSION_PREFIX + k in cached)
+    missing = [k for k in kinds if k not in versions]
+    if missing:
+        memcache.add_multi(dict((k, _initial_version()) for k in missing), key_prefix=VERSION_PREFIX)
+        versions.update(memcache.get_multi(missing, key_prefix=VERSION_PREFIX))
+    if any(k not in versions for k in kinds):
+        return None
+    return [versions[k] for k in kinds]
+
+
+def conditional(*kinds):
+    """Tags GET responses with an ETag built from the versions of kinds and the request url
+
+    A matching If-None-Match is answered with 304 before the handler runs, repeat requests for
+    an unchanged response are served from memcache. Without versions, for example while memcache
+    is down or right after a write, the handler runs and its response is sent without an ETag.
+    Tagged responses are built without the local entity cache, it can hold entities older than the versions.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            versions = get_versions(kinds)
+            if versions is None:
+                return f(*args, **kwargs)
+            etag = hashlib.md5('%s|%s|%s' % (request.host_url, request.full_path, versions)).hexdigest()
+            headers = {'ETag': '"%s"' % etag}
+            if etag in request.if_none_match:
+                return Response(status=304, headers=headers)
+
+            data = memcache.get(RESPONSE_CACHE_PREFIX + etag)
+            if data is None:
+                with entity_cache.skip_local_cache():
+                    data = f(*args, **kwargs)
+                if isinstance(data, Response):
+                    return data
+                memcache.set(RESPONSE_CACHE_PREFIX + etag, data, time=RESPONSE_CACHE_TIME)
+            return data, 200, headers
+
+        return decorated
+
+    return decorator